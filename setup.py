@@ -1,4 +1,19 @@
-from setuptools import setup
+import sys
+
+from setuptools import Extension, setup
 from Cython.Build import cythonize
 
-setup(ext_modules=cythonize("wordcloud/query_integral_image.pyx"))
+if sys.platform == "win32":
+    openmp_compile_args, openmp_link_args = ["/openmp"], []
+elif sys.platform == "darwin":
+    # Apple clang ships without OpenMP, prange then runs serially
+    openmp_compile_args, openmp_link_args = [], []
+else:
+    openmp_compile_args, openmp_link_args = ["-fopenmp"], ["-fopenmp"]
+
+extension = Extension("wordcloud.query_integral_image",
+                      ["wordcloud/query_integral_image.pyx"],
+                      extra_compile_args=openmp_compile_args,
+                      extra_link_args=openmp_link_args)
+
+setup(ext_modules=cythonize(extension))
@@ -1,11 +1,17 @@
-from wordcloud import WordCloud, get_single_color_func, ImageColorGenerator
+from wordcloud import (WordCloud, get_single_color_func, ImageColorGenerator,
+                       LayoutCache, random_color_func)
+from wordcloud.wordcloud import IntegralOccupancyMap, colormap_color_func
+from wordcloud.fonts import get_font, get_transposed_font, TextMeasurements
 
 import numpy as np
 import pytest
 
+import gzip
+import io
+from itertools import islice
 from random import Random
 from numpy.testing import assert_array_equal
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 import xml.etree.ElementTree as ET
 
 import matplotlib
@@ -206,6 +212,22 @@ def test_svg_syntax():
     ET.fromstring(svg)
 
 
+def test_write_svg(tmpdir):
+    wc = WordCloud(max_words=50, random_state=0).generate(THIS)
+    svg = wc.to_svg()
+
+    # the same document is written element by element
+    buffer = io.BytesIO()
+    wc.write_svg(buffer)
+    assert buffer.getvalue().decode("utf-8") == svg
+
+    # optionally compressed, as svgz
+    path = str(tmpdir.join("wordcloud.svgz"))
+    wc.write_svg(path, compress=True)
+    with gzip.open(path) as f:
+        assert f.read().decode("utf-8") == svg
+
+
 def test_recolor():
     wc = WordCloud(max_words=50, colormap="jet")
     wc.generate(THIS)
@@ -287,6 +309,71 @@ def test_mask_contour():
     assert all(sm_array[100, 300] == [0, 0, 255])
 
 
+def test_mask_state():
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    wc = WordCloud(mask=mask, random_state=0).generate(THIS)
+    mask_state = wc._mask_state
+    empty = mask_state.empty_occupancy(234, 456, False)
+    integral = empty.integral.copy()
+
+    # the preprocessed mask is reused and not changed by layouts
+    wc2 = WordCloud(mask=mask, random_state=0)
+    wc.random_state = Random(0)
+    wc.generate(THIS)
+    assert wc._mask_state is mask_state
+    assert_array_equal(empty.integral, integral)
+    assert wc.layout_ == wc2.generate(THIS).layout_
+
+    # the arrays can be detached, to share them with other processes
+    state, arrays = mask_state.detach_arrays()
+    assert state.boolean_mask is None
+    assert state.empty_occupancy(234, 456, False).integral is None
+    state.attach_arrays(arrays)
+    assert state.boolean_mask is mask_state.boolean_mask
+    assert state.empty_occupancy(234, 456, False).integral is empty.integral
+    wc3 = WordCloud(mask=mask, random_state=0)
+    wc3._mask_state = state
+    assert wc3.generate(THIS).layout_ == wc2.layout_
+
+    # assigning a mask resets it
+    wc.mask = mask
+    assert wc._mask_state is None
+    wc.mask = None
+    wc.generate(THIS)
+    assert wc._mask_state.boolean_mask is None
+
+
+def test_mask_contour_cached():
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    wc = WordCloud(mask=mask, contour_width=3, contour_color='blue',
+                   random_state=0).generate(THIS)
+    image = wc.to_array()
+    contour = wc._contour
+
+    # recoloring reuses the contour
+    wc.recolor(random_state=1)
+    assert_array_equal(wc.to_array()[100, 300:400], image[100, 300:400])
+    assert wc._contour is contour
+
+    # but changing the mask or contour_width does not
+    wc.contour_width = 5
+    wc.to_array()
+    assert wc._contour is not contour
+    contour = wc._contour
+    new_mask = wc.mask.copy()
+    new_mask[100:120] = 0
+    wc.mask = new_mask
+    wc.to_array()
+    assert wc._contour is not contour
+
+    # contours work in RGBA mode
+    wc = WordCloud(mask=mask, contour_width=3, contour_color='blue',
+                   mode="RGBA", background_color=None).generate(THIS)
+    assert all(wc.to_array()[100, 300] == [0, 0, 255, 255])
+
+
 def test_single_color_func():
     # test single color function for different color formats
     random = Random(42)
@@ -407,6 +494,33 @@ def test_recolor_too_small_set_default():
     wc.recolor(color_func=image_colors)
 
 
+def test_image_color_generator_mean():
+    # the colors are the mean of the image under the word box
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, size=(200, 400, 3)).astype(np.uint8)
+    gray = image[:, :, 0]
+    wc = WordCloud(max_words=50, random_state=0).generate(THIS)
+    for colouring in [image, gray]:
+        image_colors = ImageColorGenerator(colouring)
+        for (word, _), font_size, position, orientation, _ in wc.layout_:
+            width, height = image_colors._measurements.box(
+                word, wc.font_path, font_size, orientation)
+            x, y = position
+            patch = colouring[x:x + width, y:y + height]
+            if patch.ndim == 3:
+                color = tuple(patch.reshape(-1, 3).mean(axis=0))
+            else:
+                color = (patch.mean(),) * 3
+            assert image_colors(word, font_size, wc.font_path, position,
+                                orientation) == "rgb(%d, %d, %d)" % color
+
+        # recolor uses the batch interface, which gives the same colors
+        wc.recolor(color_func=image_colors)
+        for (word, _), font_size, position, orientation, color in wc.layout_:
+            assert "rgb(%d, %d, %d)" % color == image_colors(
+                word, font_size, wc.font_path, position, orientation)
+
+
 def test_small_canvas():
     # check font size fallback works on small canvas
     wc = WordCloud(max_words=50, width=21, height=21)
@@ -502,3 +616,398 @@ def test_max_font_size_as_mask_height():
 
     # Check if the biggest element has the same font size
     assert wc.layout_[0][1] == wc2.layout_[0][1]
+
+
+def test_occupancy_box_update():
+    # patching the integral image with the changed box is the same as
+    # recomputing the whole bottom right
+    rng = np.random.RandomState(0)
+    img_array = (rng.rand(60, 80) > .95).astype(np.uint8)
+    full = IntegralOccupancyMap(60, 80, None)
+    full.update(img_array, 0, 0)
+    box = IntegralOccupancyMap(60, 80, None)
+    box.integral[:] = full.integral
+    for pos_x, pos_y, size_x, size_y in [(10, 30, 7, 15), (0, 5, 3, 9),
+                                         (40, 0, 20, 4), (55, 70, 10, 20)]:
+        img_array[pos_x:pos_x + size_x, pos_y:pos_y + size_y] = rng.randint(
+            0, 256, size=img_array[pos_x:pos_x + size_x,
+                                   pos_y:pos_y + size_y].shape)
+        full.update(img_array, pos_x, pos_y)
+        box.update(img_array, pos_x, pos_y, size_x, size_y)
+        assert_array_equal(full.integral, box.integral)
+
+
+def test_max_probes():
+    # probing is deterministic and respects the mask
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    wc = WordCloud(mask=mask, max_probes=50, random_state=1).generate(THIS)
+    wc2 = WordCloud(mask=mask, max_probes=50, random_state=1).generate(THIS)
+    assert_array_equal(wc, wc2)
+    wc_array = np.array(wc)
+    assert_array_equal(wc_array[mask != 0], 0)
+    assert len(wc.layout_) == len(wc.words_)
+
+
+def test_coarse_search():
+    # coarse-to-fine search finds the same positions as the full scan
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    wc = WordCloud(mask=mask, random_state=3).generate(THIS)
+    wc_coarse = WordCloud(mask=mask, random_state=3,
+                          coarse_search=True).generate(THIS)
+    assert wc.layout_ == wc_coarse.layout_
+
+
+def test_n_jobs():
+    # the parallel scan finds the same positions as the serial one
+    wc = WordCloud(random_state=5).generate(THIS)
+    wc_parallel = WordCloud(random_state=5, n_jobs=2).generate(THIS)
+    assert wc.layout_ == wc_parallel.layout_
+
+    with pytest.raises(ValueError, match="n_jobs"):
+        WordCloud(n_jobs=0)
+
+
+def test_glyph_collision():
+    # words may share boxes, but their pixels never overlap
+    mask = np.zeros((150, 200), dtype=int)
+    mask[50:100, 100:150] = 255
+    wc = WordCloud(mask=mask, collision="glyph", margin=0,
+                   random_state=0).generate(THIS)
+    coverage = np.zeros(mask.shape, dtype=int)
+    for (word, _), font_size, (x, y), orientation, _ in wc.layout_:
+        img = Image.new("L", (mask.shape[1], mask.shape[0]))
+        font = ImageFont.TransposedFont(
+            ImageFont.truetype(wc.font_path, font_size),
+            orientation=orientation)
+        ImageDraw.Draw(img).text((y, x), word, fill="white", font=font)
+        coverage += np.asarray(img) > 0
+    assert coverage.max() == 1
+    assert not coverage[mask != 0].any()
+
+    with pytest.raises(ValueError, match="collision"):
+        WordCloud(collision="pixel")
+
+
+def test_spiral_placement():
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    wc = WordCloud(mask=mask, placement="spiral", random_state=2)
+    wc.generate(THIS)
+    wc2 = WordCloud(mask=mask, placement="spiral", random_state=2)
+    wc2.generate(THIS)
+    assert wc.layout_ == wc2.layout_
+    wc_array = np.array(wc)
+    assert_array_equal(wc_array[mask != 0], 0)
+    assert wc_array[mask == 0].sum() > 10000
+
+    with pytest.raises(ValueError, match="placement"):
+        WordCloud(placement="grid")
+
+
+def test_occupancy_infeasible_sizes():
+    # once a box doesn't fit, larger boxes are rejected without a scan
+    mask = np.ones((50, 80), dtype=bool)
+    mask[10:40, 10:70] = False
+    occupancy = IntegralOccupancyMap(50, 80, mask)
+    random_state = Random(0)
+    assert occupancy.sample_position(5, 20, random_state) is not None
+    assert not occupancy.known_infeasible(31, 20)
+    assert occupancy.sample_position(31, 20, random_state) is None
+    assert occupancy.known_infeasible(31, 20)
+    assert occupancy.known_infeasible(32, 40)
+    assert not occupancy.known_infeasible(30, 40)
+    assert not occupancy.known_infeasible(32, 19)
+
+
+def test_occupancy_free_squares():
+    # the largest free square follows updates without rescanning the canvas
+    mask = np.ones((50, 80), dtype=bool)
+    mask[10:20, 10:40] = False
+    mask[30:45, 50:75] = False
+    occupancy = IntegralOccupancyMap(50, 80, mask)
+    assert occupancy.largest_free_square() == 15
+    assert occupancy.known_infeasible(16, 30)
+    assert occupancy.sample_position(16, 30, Random(0)) is None
+
+    img_array = mask.astype(np.uint8)
+    img_array[35:40, 60:65] = 1
+    occupancy.update(img_array, 35, 60, 5, 5)
+    assert occupancy.largest_free_square() == 10
+    img_array[19, 10:40] = 1
+    occupancy.update(img_array, 19, 10, 1, 30)
+    assert occupancy.largest_free_square() == 10
+    img_array[30:45, 65:75] = 1
+    occupancy.update(img_array, 30, 65, 15, 10)
+    assert occupancy.largest_free_square() == 10
+    img_array[30:45, 50:55] = 1
+    occupancy.update(img_array, 30, 50)
+    assert occupancy.largest_free_square() == 9
+
+
+def test_font_cache():
+    # fonts are loaded once per path, size and orientation
+    wc = WordCloud()
+    font = get_transposed_font(wc.font_path, 20, Image.ROTATE_90)
+    assert get_transposed_font(wc.font_path, 20, Image.ROTATE_90) is font
+    assert get_transposed_font(wc.font_path, 20) is not font
+    assert font.font is get_font(wc.font_path, 20)
+    assert get_font(wc.font_path, 21) is not font.font
+
+
+def test_text_measurements():
+    wc = WordCloud()
+    measurements = TextMeasurements(max_entries=2)
+    font = get_transposed_font(wc.font_path, 20, Image.ROTATE_90)
+    width, height = measurements.box("Zen", wc.font_path, 20, Image.ROTATE_90)
+    assert (width, height) == font.getbbox("Zen")[2:]
+    assert measurements.box("Zen", wc.font_path, 20) == (height, width)
+    # full caches are emptied instead of growing
+    measurements.box("Python", wc.font_path, 20)
+    assert len(measurements._boxes) == 1
+
+    # measurements are reused by later layouts
+    wc = WordCloud(random_state=0).generate(THIS)
+    layout = wc.layout_
+    wc.random_state = Random(0)
+    assert wc.generate(THIS).layout_ == layout
+
+
+def test_font_size_search():
+    # bisection finds the same font sizes as stepping down one at a time
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    for kwargs in [dict(), dict(mask=mask, prefer_horizontal=.5),
+                   dict(font_step=3, repeat=True)]:
+        wc = WordCloud(random_state=1, **kwargs).generate(THIS)
+        wc2 = WordCloud(random_state=1, font_size_search="bisect",
+                        **kwargs).generate(THIS)
+        assert wc.layout_ == wc2.layout_
+
+    with pytest.raises(ValueError, match="font_size_search"):
+        WordCloud(font_size_search="binary")
+
+
+def test_max_font_size_estimate():
+    # the sizing layout is only done once for the same words and state
+    wc = WordCloud(random_state=0).generate(THIS)
+    layout = wc.layout_
+    wc.random_state = Random(0)
+    wc.generate(THIS)
+    assert wc.layout_ == layout
+    assert len(wc._max_font_sizes) == 1
+
+    wc = WordCloud().generate(THIS)
+    estimates = dict(wc._max_font_sizes)
+    wc.generate(THIS)
+    assert wc._max_font_sizes == estimates
+    assert len(wc._max_font_sizes) == 1
+
+
+def test_generate_many():
+    mask = np.zeros((234, 456), dtype=int)
+    mask[100:150, 300:400] = 255
+    items = [THIS, {"hello": 3, "world": 1}, THIS[:300]]
+    wc = WordCloud(mask=mask, max_words=50, random_state=0)
+    layouts = wc.generate_many(items, max_workers=2)
+    assert not hasattr(wc, "layout_")
+
+    # each item gets its own seed, drawn from random_state
+    random_state = Random(0)
+    for item, layout in zip(items, layouts):
+        wc = WordCloud(mask=mask, max_words=50,
+                       random_state=random_state.randint(0, 2 ** 32 - 1))
+        if isinstance(item, str):
+            wc.generate(item)
+        else:
+            wc.generate_from_frequencies(item)
+        assert wc.layout_ == layout
+
+    images = WordCloud(mask=mask, random_state=0).generate_many(
+        items[:2], max_workers=1, output="image")
+    assert [image.size for image in images] == [(456, 234)] * 2
+
+    # the bit-packed mask for glyph collisions is shared as well
+    kwargs = dict(mask=mask, max_words=50, collision="glyph")
+    layout, = WordCloud(random_state=0, **kwargs).generate_many(
+        items[1:2], max_workers=1)
+    wc = WordCloud(random_state=Random(0).randint(0, 2 ** 32 - 1), **kwargs)
+    assert wc.generate_from_frequencies(items[1]).layout_ == layout
+
+    with pytest.raises(ValueError, match="output"):
+        wc.generate_many(items, output="svg")
+
+
+def test_time_budget():
+    wc = WordCloud(random_state=0, max_words=50).generate(THIS)
+    assert wc.n_words_skipped_ == 0
+    wc2 = WordCloud(random_state=0, max_words=50,
+                    time_budget=60).generate(THIS)
+    assert wc2.layout_ == wc.layout_
+    assert wc2.n_words_skipped_ == 0
+
+    # without time, no words are placed and all are reported as skipped
+    wc = WordCloud(random_state=0, max_words=50, time_budget=0).generate(THIS)
+    assert wc.layout_ == []
+    assert wc.n_words_skipped_ == len(wc.words_)
+    # the budget also bounds the estimate of max_font_size, which is not
+    # remembered when it runs out of time
+    assert wc._max_font_sizes == {}
+
+
+@pytest.mark.parametrize("max_font_size", [None, 300])
+def test_update_from_frequencies(max_font_size):
+    # with max_font_size=300, the largest word is made smaller to fit
+    wc = WordCloud(random_state=0, max_words=50, max_font_size=max_font_size)
+    frequencies = wc.process_text(THIS)
+    layout = wc.generate_from_frequencies(frequencies).layout_
+    # nothing changed, so nothing moves
+    assert wc.update_from_frequencies(frequencies).layout_ == layout
+
+    # a new word is placed around the words that keep their size
+    frequencies = dict(frequencies, zen=3)
+    wc.update_from_frequencies(frequencies)
+    assert "zen" in [word for (word, _), _, _, _, _ in wc.layout_]
+    kept = set(layout) & set(wc.layout_)
+    assert len(kept) == len(layout) - 1
+    wc_array = np.array(wc.to_image().convert("L"))
+    assert wc_array.sum() > 0
+
+    with pytest.raises(ValueError, match="generate"):
+        WordCloud().update_from_frequencies(frequencies)
+
+
+def test_update_from_frequencies_full_canvas():
+    # the canvas fills up before max_words are placed
+    wc = WordCloud(width=100, height=100, random_state=0)
+    frequencies = wc.process_text(THIS)
+    layout = wc.generate_from_frequencies(frequencies).layout_
+    assert len(layout) < min(len(frequencies), wc.max_words)
+    assert wc.update_from_frequencies(frequencies).layout_ == layout
+
+
+def test_layout_cache(tmpdir):
+    cache = LayoutCache(str(tmpdir))
+    wc = WordCloud(random_state=0, layout_cache=cache).generate(THIS)
+    assert len(tmpdir.listdir()) == 1
+    # a hit gives the same layout and leaves the random state as a layout
+    wc2 = WordCloud(random_state=0, layout_cache=cache).generate(THIS)
+    assert wc2.layout_ == wc.layout_
+    assert wc2.words_ == wc.words_
+    assert wc2.random_state.getstate() == wc.random_state.getstate()
+    assert_array_equal(wc2.to_array(), wc.to_array())
+    assert len(tmpdir.listdir()) == 1
+
+    # other parameters or states are stored separately
+    WordCloud(random_state=0, margin=4, layout_cache=cache).generate(THIS)
+    wc.generate(THIS)
+    assert len(tmpdir.listdir()) == 3
+    # without a random state, or with an unknown color_func, nothing is cached
+    WordCloud(layout_cache=cache).generate(THIS)
+    WordCloud(random_state=0, layout_cache=cache,
+              color_func=get_single_color_func("red")).generate(THIS)
+    assert len(tmpdir.listdir()) == 3
+
+    # the least recently used layouts are removed first
+    cache.max_size = 1
+    WordCloud(random_state=1, layout_cache=cache).generate(THIS)
+    assert len(tmpdir.listdir()) == 0
+    cache.max_size = 10 ** 6
+    wc = WordCloud(random_state=1, layout_cache=cache).generate(THIS)
+    cache.clear()
+    assert len(tmpdir.listdir()) == 0
+
+
+def test_iter_layout(monkeypatch):
+    wc = WordCloud(max_words=50, random_state=0).generate(THIS)
+
+    wc2 = WordCloud(max_words=50, random_state=0)
+    words = wc2.process_text(THIS)
+    placed = []
+    for placement in wc2.iter_layout(words):
+        placed.append(placement)
+        # the layout is available while iterating
+        assert wc2.layout_ == placed
+    assert placed == wc.layout_
+    assert wc2.words_ == wc.words_
+
+    # stopping early leaves a partial layout
+    wc3 = WordCloud(max_words=50, random_state=0)
+    for placement in islice(wc3.iter_layout(words), 3):
+        pass
+    assert wc3.layout_ == wc.layout_[:3]
+    assert wc3.to_image().size == wc.to_image().size
+
+    # closing the generator early still shuts down the thread pool and
+    # forgets the rendered words that did not make it into the layout
+    wc4 = WordCloud(max_words=50, random_state=0, keep_sprites=True,
+                    speculative=True, n_jobs=2).generate(THIS)
+    pools = []
+
+    def candidate_pool():
+        pools.append(WordCloud._candidate_pool(wc4))
+        return pools[-1]
+
+    monkeypatch.setattr(wc4, "_candidate_pool", candidate_pool)
+    layout = wc4.iter_layout(words)
+    for placement in islice(layout, 3):
+        pass
+    layout.close()
+    assert len(wc4._sprites) == 3
+    with pytest.raises(RuntimeError):
+        pools[0].submit(print)
+
+
+@pytest.mark.parametrize("font_size_search", ["linear", "bisect"])
+def test_speculative(font_size_search):
+    # candidates are scanned in advance, but the same ones are chosen
+    kwargs = dict(width=200, height=150, prefer_horizontal=.5, max_probes=5,
+                  font_size_search=font_size_search)
+    wc = WordCloud(random_state=0, **kwargs).generate(THIS)
+    wc2 = WordCloud(random_state=0, speculative=True, n_jobs=3,
+                    **kwargs).generate(THIS)
+    assert wc2.layout_ == wc.layout_
+
+    # a single thread does not scan in advance
+    assert WordCloud(speculative=True)._candidate_pool() is None
+
+
+@pytest.mark.parametrize("scale", [1, 1.5])
+def test_keep_sprites(scale):
+    wc = WordCloud(max_words=50, random_state=0, scale=scale).generate(THIS)
+    wc2 = WordCloud(max_words=50, random_state=0, scale=scale,
+                    keep_sprites=True).generate(THIS)
+    assert wc2.layout_ == wc.layout_
+    assert_array_equal(wc2.to_array(), wc.to_array())
+
+    # the rendered words are reused after recoloring
+    n_sprites = len(wc2._sprites)
+    assert n_sprites >= len(wc2.layout_)
+    wc.recolor(random_state=1)
+    wc2.recolor(random_state=1)
+    assert_array_equal(wc2.to_array(), wc.to_array())
+    assert len(wc2._sprites) == n_sprites
+
+    # sprites of words that are no longer in the layout are dropped
+    wc2.generate("hello world")
+    assert len(wc2._sprites) == 2
+
+
+@pytest.mark.parametrize("color_func", [
+    random_color_func, colormap_color_func("jet"),
+    get_single_color_func("deepskyblue")])
+def test_recolor_batch(color_func):
+    wc = WordCloud(max_words=50, random_state=0).generate(THIS)
+    wc.recolor(random_state=3, color_func=color_func)
+    # colors are (r, g, b) tuples
+    assert all(isinstance(color, tuple) for *_, color in wc.layout_)
+    image = wc.to_array()
+    assert "rgb(" in wc.to_svg()
+
+    # the same colors as calling color_func for each word
+    def one_by_one(*args, **kwargs):
+        return color_func(*args, **kwargs)
+
+    wc.recolor(random_state=3, color_func=one_by_one)
+    assert_array_equal(wc.to_array(), image)
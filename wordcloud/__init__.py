@@ -1,9 +1,10 @@
 from .wordcloud import (WordCloud, STOPWORDS, random_color_func,
                         get_single_color_func)
 from .color_from_image import ImageColorGenerator
+from .layout_cache import LayoutCache
 
 __all__ = ['WordCloud', 'STOPWORDS', 'random_color_func',
-           'get_single_color_func', 'ImageColorGenerator',
+           'get_single_color_func', 'ImageColorGenerator', 'LayoutCache',
            '__version__']
 
 from ._version import __version__
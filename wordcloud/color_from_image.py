@@ -1,19 +1,21 @@
 import numpy as np
-from PIL import ImageFont
+
+from .fonts import TextMeasurements
 
 
 class ImageColorGenerator(object):
     """Color generator based on a color image.
 
-    Generates colors based on an RGB image. A word will be colored using
-    the mean color of the enclosing rectangle in the color image.
+    Generates colors based on an RGB or gray-scale image. A word will be
+    colored using the mean color of the enclosing rectangle in the color
+    image.
 
     After construction, the object acts as a callable that can be passed as
     color_func to the word cloud constructor or to the recolor method.
 
     Parameters
     ----------
-    image : nd-array, shape (height, width, 3)
+    image : nd-array, shape (height, width, 3) or (height, width)
         Image to use to generate word colors. Alpha channels are ignored.
         This should be the same size as the canvas. for the wordcloud.
     default_color : tuple or None, default=None
@@ -30,29 +32,75 @@ class ImageColorGenerator(object):
                              % image.shape[2])
         self.image = image
         self.default_color = default_color
+        self._measurements = TextMeasurements()
+        # summed area table of each channel, with a row and a column of
+        # zeros in front, so the sum over any rectangle takes four lookups
+        if image.ndim == 3:
+            # drop alpha channel if any
+            channels = image[:, :, :3]
+        else:
+            channels = image[:, :, np.newaxis]
+        height, width = image.shape[:2]
+        if image.dtype.kind in "fc":
+            dtype = np.float64
+        elif image.dtype.kind in "bu" and height * width * 255 < 2 ** 32:
+            # enough for 8 bit images with up to 16 million pixels
+            dtype = np.uint32
+        else:
+            dtype = np.int64
+        self._integral = np.zeros((height + 1, width + 1, channels.shape[2]),
+                                  dtype=dtype)
+        np.cumsum(np.cumsum(channels, axis=0, dtype=dtype), axis=1,
+                  out=self._integral[1:, 1:])
 
     def __call__(self, word, font_size, font_path, position, orientation, **kwargs):
         """Generate a color for a given word using a fixed image."""
-        # get the font to get the box size
-        font = ImageFont.truetype(font_path, font_size)
-        transposed_font = ImageFont.TransposedFont(font,
-                                                   orientation=orientation)
         # get size of resulting text
-        box_size = transposed_font.getbbox(word)
-        x = position[0]
-        y = position[1]
-        # cut out patch under word box
-        patch = self.image[x:x + box_size[2], y:y + box_size[3]]
-        if patch.ndim == 3:
-            # drop alpha channel if any
-            patch = patch[:, :, :3]
-        if patch.ndim == 2:
-            raise NotImplementedError("Gray-scale images TODO")
-        # check if the text is within the bounds of the image
-        reshape = patch.reshape(-1, 3)
-        if not np.all(reshape.shape):
-            if self.default_color is None:
-                raise ValueError('ImageColorGenerator is smaller than the canvas')
-            return "rgb(%d, %d, %d)" % tuple(self.default_color)
-        color = np.mean(reshape, axis=0)
-        return "rgb(%d, %d, %d)" % tuple(color)
+        box_size = self._measurements.box(word, font_path, font_size,
+                                          orientation)
+        # mean color of the patch under the word box
+        color = self._mean_colors(np.array([position]), np.array([box_size]))
+        return "rgb(%d, %d, %d)" % tuple(color[0])
+
+    def batch(self, words, font_sizes, positions, orientations,
+              font_path=None, random_state=None):
+        """Generate the colors of several words at once.
+
+        Returns an array of shape (n_words, 3) with the same colors as
+        calling the generator for each word.
+        """
+        box_sizes = [self._measurements.box(word, font_path, font_size,
+                                            orientation)
+                     for word, font_size, orientation
+                     in zip(words, font_sizes, orientations)]
+        colors = self._mean_colors(np.asarray(positions).reshape(-1, 2),
+                                   np.array(box_sizes, dtype=int).reshape(-1, 2))
+        return np.clip(colors, 0, 255).astype(np.uint8)
+
+    def _mean_colors(self, positions, box_sizes):
+        """Mean colors of the image under the boxes at positions.
+
+        Like slicing ``image[x:x + box_size[0], y:y + box_size[1]]``, boxes
+        are cut off at the border of the image. Boxes that are entirely
+        outside of it get default_color.
+        """
+        height, width = self.image.shape[:2]
+        x0 = np.minimum(positions[:, 0], height)
+        y0 = np.minimum(positions[:, 1], width)
+        x1 = np.clip(positions[:, 0] + box_sizes[:, 0], x0, height)
+        y1 = np.clip(positions[:, 1] + box_sizes[:, 1], y0, width)
+        area = (x1 - x0) * (y1 - y0)
+        outside = area == 0
+        if outside.any() and self.default_color is None:
+            raise ValueError('ImageColorGenerator is smaller than the canvas')
+        integral = self._integral
+        # unsigned sums wrap around in between, but not in the result
+        total = (integral[x1, y1] - integral[x0, y1] - integral[x1, y0]
+                 + integral[x0, y0])
+        colors = total / np.maximum(area, 1)[:, np.newaxis]
+        if colors.shape[1] == 1:
+            # gray-scale image
+            colors = np.repeat(colors, 3, axis=1)
+        if outside.any():
+            colors[outside] = self.default_color
+        return colors
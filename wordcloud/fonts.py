@@ -0,0 +1,85 @@
+from functools import lru_cache
+
+from PIL import ImageFont
+
+# number of (font path, size, orientation) combinations to keep loaded.
+# A layout typically uses a few dozen sizes in two orientations.
+FONT_CACHE_SIZE = 512
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(font_path, font_size):
+    """Load a FreeType font, reusing fonts that were loaded before.
+
+    The cache is shared by the whole process and can be used from several
+    threads. The returned font must not be modified.
+    """
+    return ImageFont.truetype(font_path, font_size)
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_transposed_font(font_path, font_size, orientation=None):
+    """Load a font wrapped to draw text with the given orientation.
+
+    Like get_font, the fonts are cached for the whole process.
+    """
+    return ImageFont.TransposedFont(get_font(font_path, font_size),
+                                    orientation=orientation)
+
+
+class TextMeasurements(object):
+    """Memoized sizes of words drawn with the cached fonts.
+
+    Measurements are keyed by word, font path, font size and orientation,
+    so one instance can be kept across several layouts. If more than
+    max_entries measurements of a kind are stored, they are all dropped.
+
+    Parameters
+    ----------
+    max_entries : int (default=100000)
+        Number of measurements of each kind to keep.
+    """
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._boxes = {}
+        self._metrics = {}
+
+    def box(self, word, font_path, font_size, orientation=None):
+        """Width and height of word as drawn with get_transposed_font."""
+        key = (word, font_path, font_size, orientation)
+        try:
+            return self._boxes[key]
+        except KeyError:
+            pass
+        font = get_transposed_font(font_path, font_size, orientation)
+        box = font.getbbox(word)[2:]
+        self._store(self._boxes, key, box)
+        return box
+
+    def metrics(self, word, font_path, font_size):
+        """Size and offset of word and ascent and descent of the font.
+
+        These are the values of ``font.font.getsize(word)`` and
+        ``font.getmetrics()`` for the font returned by get_font.
+        """
+        key = (word, font_path, font_size)
+        try:
+            return self._metrics[key]
+        except KeyError:
+            pass
+        font = get_font(font_path, font_size)
+        (size_x, size_y), (offset_x, offset_y) = font.font.getsize(word)
+        ascent, descent = font.getmetrics()
+        metrics = ((size_x, size_y), (offset_x, offset_y), ascent, descent)
+        self._store(self._metrics, key, metrics)
+        return metrics
+
+    def clear(self):
+        """Forget all measurements."""
+        self._boxes.clear()
+        self._metrics.clear()
+
+    def _store(self, cache, key, value):
+        if len(cache) >= self.max_entries:
+            cache.clear()
+        cache[key] = value
@@ -0,0 +1,101 @@
+import gzip
+import json
+import os
+import tempfile
+
+
+class LayoutCache(object):
+    """On-disk cache of word cloud layouts.
+
+    Layouts are stored as gzipped JSON files named after a hash of
+    everything the layout depends on, so a cache directory can be shared
+    by several processes. The least recently used files are removed when
+    the total size of the cache exceeds max_size.
+
+    Pass an instance as ``layout_cache`` to :class:`WordCloud`. Only word
+    clouds with a fixed random_state use the cache.
+
+    Parameters
+    ----------
+    directory : string
+        Directory to store the layouts in. It is created if it does not
+        exist.
+
+    max_size : int (default=100 * 2 ** 20)
+        Maximum total size of the cached layouts in bytes.
+    """
+    suffix = ".json.gz"
+
+    def __init__(self, directory, max_size=100 * 2 ** 20):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Return the value stored for key, or None if there is none."""
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, EOFError, ValueError):
+            # missing, evicted meanwhile, or partially written by an old
+            # version of the file
+            return None
+        try:
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Store a JSON serializable value for key."""
+        data = gzip.compress(json.dumps(value).encode("utf-8"))
+        # write to a temporary file first, so readers never see a partial
+        # file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def clear(self):
+        """Remove all cached layouts."""
+        for entry in self._entries():
+            _remove(entry.path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries
+                    if entry.name.endswith(self.suffix)]
+
+    def _evict(self):
+        files = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        # remove the least recently used files first
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            _remove(path)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        # another process removed it first
+        pass
@@ -3,6 +3,8 @@
 # cython: wraparound=False
 import array
 import numpy as np
+from cython.parallel import prange
+from libc.math cimport cos, sin, sqrt, lround
 
 
 def query_integral_image(unsigned int[:,:] integral_image, int size_x, int
@@ -33,3 +35,405 @@ def query_integral_image(unsigned int[:,:] integral_image, int size_x, int
                 hits += 1
                 if hits == goal:
                     return i, j
+
+
+def probe_integral_image(unsigned int[:,:] integral_image, int size_x,
+                         int size_y, random_state, int n_probes):
+    """Try n_probes random positions, return the first free one or None.
+
+    Each free position is equally likely to be returned, as with
+    query_integral_image, but the cost does not depend on the canvas size.
+    """
+    cdef int x = integral_image.shape[0]
+    cdef int y = integral_image.shape[1]
+    cdef int area, i, j, k
+    if x - size_x <= 0 or y - size_y <= 0:
+        return None
+    for k in range(n_probes):
+        i = random_state.randint(0, x - size_x - 1)
+        j = random_state.randint(0, y - size_y - 1)
+        area = integral_image[i, j] + integral_image[i + size_x, j + size_y]
+        area -= integral_image[i + size_x, j] + integral_image[i, j + size_y]
+        if not area:
+            return i, j
+    return None
+
+
+cdef struct Box:
+    # size of the box, and of a solid rectangle (the core) inside it
+    int size_x, size_y, core_i, core_j, core_x, core_y
+    # whether only the pixels of the sprite have to be free
+    bint use_sprite
+
+
+cdef inline unsigned int _area(unsigned int[:,:] integral_image, int i0,
+                               int j0, int i1, int j1) nogil:
+    # sum over rows (i0, i1] and columns (j0, j1]
+    return (integral_image[i0, j0] + integral_image[i1, j1]
+            - integral_image[i1, j0] - integral_image[i0, j1])
+
+
+cdef inline unsigned long long _bits(unsigned long long[:,:] bit_image,
+                                     int row, int col) nogil:
+    # 64 pixels of a bit-packed row, starting at column col
+    cdef int k = col >> 6
+    cdef int s = col & 63
+    if not s:
+        return bit_image[row, k]
+    return (bit_image[row, k] >> s) | (bit_image[row, k + 1] << (64 - s))
+
+
+cdef inline bint _free(unsigned int[:,:] integral_image,
+                       unsigned long long[:,:] bit_image,
+                       unsigned long long[:,:] sprite, int[:] row_order,
+                       Box box, int i, int j) nogil:
+    # is the box (or the sprite) at position (i, j) free? The box covers
+    # rows i + 1 .. i + size_x and columns j + 1 .. j + size_y.
+    cdef int k, r, m
+    if not _area(integral_image, i, j, i + box.size_x, j + box.size_y):
+        return True
+    if not box.use_sprite:
+        return False
+    # the core is a solid rectangle of the sprite: if it is occupied, the
+    # sprite collides
+    if _area(integral_image, i + box.core_i, j + box.core_j,
+             i + box.core_i + box.core_x, j + box.core_j + box.core_y):
+        return False
+    # rows with many set pixels come first, they are likely to collide
+    for k in range(box.size_x):
+        r = row_order[k]
+        for m in range(sprite.shape[1]):
+            if sprite[r, m] & _bits(bit_image, i + 1 + r, j + 1 + 64 * m):
+                return False
+    return True
+
+
+cdef unsigned int _count_block(unsigned int[:,:] integral_image,
+                               unsigned long long[:,:] bit_image,
+                               unsigned long long[:,:] sprite,
+                               int[:] row_order, Box box, bint coarse, int i0,
+                               int i1, int j0, int j1,
+                               unsigned int[:] row_hits) nogil:
+    # count free positions (i, j) with i0 <= i < i1 and j0 <= j < j1
+    cdef unsigned int hits = 0, row
+    cdef int i, j
+    if coarse:
+        # if the union of all boxes in the block is free, all positions are
+        if not _area(integral_image, i0, j0, i1 - 1 + box.size_x,
+                     j1 - 1 + box.size_y):
+            for i in range(i0, i1):
+                row_hits[i] += j1 - j0
+            return (i1 - i0) * (j1 - j0)
+        # if the intersection of their cores is occupied, none is
+        if (i1 - 1 < i0 + box.core_x and j1 - 1 < j0 + box.core_y
+                and _area(integral_image, i1 - 1 + box.core_i,
+                          j1 - 1 + box.core_j, i0 + box.core_i + box.core_x,
+                          j0 + box.core_j + box.core_y)):
+            return 0
+    if not coarse or (i1 - i0 <= 8 and j1 - j0 <= 8):
+        for i in range(i0, i1):
+            row = 0
+            if box.use_sprite:
+                for j in range(j0, j1):
+                    if _free(integral_image, bit_image, sprite, row_order,
+                             box, i, j):
+                        row += 1
+            else:
+                for j in range(j0, j1):
+                    if not _area(integral_image, i, j, i + box.size_x,
+                                 j + box.size_y):
+                        row += 1
+            row_hits[i] += row
+            hits += row
+        return hits
+    # otherwise look at both halves of the block at a finer resolution
+    if i1 - i0 >= j1 - j0:
+        i = (i0 + i1) // 2
+        return (_count_block(integral_image, bit_image, sprite, row_order, box,
+                             coarse, i0, i, j0, j1, row_hits)
+                + _count_block(integral_image, bit_image, sprite, row_order,
+                               box, coarse, i, i1, j0, j1, row_hits))
+    j = (j0 + j1) // 2
+    return (_count_block(integral_image, bit_image, sprite, row_order, box,
+                         coarse, i0, i1, j0, j, row_hits)
+            + _count_block(integral_image, bit_image, sprite, row_order, box,
+                           coarse, i0, i1, j, j1, row_hits))
+
+
+cdef unsigned int _count_rows(unsigned int[:,:] integral_image,
+                              unsigned long long[:,:] bit_image,
+                              unsigned long long[:,:] sprite,
+                              int[:] row_order, Box box, bint coarse,
+                              unsigned int[:] row_hits, int num_threads):
+    cdef int x = integral_image.shape[0]
+    cdef int y = integral_image.shape[1]
+    cdef int band, i0, i1
+    cdef int n_bands = (x - box.size_x + 15) // 16
+    cdef unsigned int hits = 0
+    row_hits[:] = 0
+    if x - box.size_x <= 0 or y - box.size_y <= 0:
+        return 0
+    for band in prange(n_bands, nogil=True, num_threads=num_threads,
+                       schedule='dynamic'):
+        i0 = band * 16
+        i1 = min(i0 + 16, x - box.size_x)
+        hits += _count_block(integral_image, bit_image, sprite, row_order, box,
+                             coarse, i0, i1, 0, y - box.size_y, row_hits)
+    return hits
+
+
+cdef _find_hit(unsigned int[:,:] integral_image,
+               unsigned long long[:,:] bit_image,
+               unsigned long long[:,:] sprite, int[:] row_order, Box box,
+               int row, int goal):
+    cdef int y = integral_image.shape[1]
+    cdef int j
+    cdef int hits = 0
+    for j in range(y - box.size_y):
+        if _free(integral_image, bit_image, sprite, row_order, box, row, j):
+            hits += 1
+            if hits == goal:
+                return j
+
+
+cdef _spiral(unsigned int[:,:] integral_image,
+             unsigned long long[:,:] bit_image,
+             unsigned long long[:,:] sprite, int[:] row_order, Box box,
+             random_state):
+    cdef int x = integral_image.shape[0] - box.size_x
+    cdef int y = integral_image.shape[1] - box.size_y
+    cdef int i0, j0, i, j, step, direction
+    cdef double t, ratio, max_t
+    if x <= 0 or y <= 0:
+        return None
+    # start around the center, like d3-cloud
+    i0 = <int>(x * (random_state.random() + .5)) // 2
+    j0 = <int>(y * (random_state.random() + .5)) // 2
+    direction = 1 if random_state.random() < .5 else -1
+    # the spiral is stretched like the canvas, and ends when it encloses it
+    ratio = y / <double>x
+    max_t = sqrt(max(i0, x - i0) ** 2 + (max(j0, y - j0) / ratio) ** 2)
+    with nogil:
+        step = 0
+        while True:
+            t = .1 * step
+            if t > max_t:
+                break
+            i = i0 + lround(t * sin(direction * t))
+            j = j0 + lround(ratio * t * cos(direction * t))
+            if (0 <= i < x and 0 <= j < y
+                    and _free(integral_image, bit_image, sprite, row_order, box,
+                              i, j)):
+                with gil:
+                    return i, j
+            step += 1
+    return None
+
+
+cdef Box _box(int size_x, int size_y):
+    return Box(size_x, size_y, 0, 0, size_x, size_y, False)
+
+
+cdef Box _sprite_box(unsigned long long[:,:] sprite, int size_y, core):
+    core_i, core_j, core_x, core_y = core
+    return Box(sprite.shape[0], size_y, core_i, core_j, core_x, core_y, True)
+
+
+cdef unsigned long long[:,:] _NO_BITS = np.zeros((1, 1), dtype=np.uint64)
+cdef int[:] _NO_ROWS = np.zeros(1, dtype=np.intc)
+
+
+def count_row_hits(unsigned int[:,:] integral_image, int size_x, int size_y,
+                   unsigned int[:] row_hits, bint coarse=True,
+                   int num_threads=1):
+    """Count the free positions in each row into row_hits.
+
+    If coarse is True, blocks of positions are first checked at a coarse
+    resolution, using the integral image: blocks that are entirely blocked
+    or entirely free are not scanned.
+
+    Bands of rows are counted in parallel on num_threads threads, without
+    holding the GIL. Returns the total number of free positions.
+    """
+    return _count_rows(integral_image, _NO_BITS, _NO_BITS, _NO_ROWS,
+                       _box(size_x, size_y), coarse, row_hits, num_threads)
+
+
+def find_row_hit(unsigned int[:,:] integral_image, int size_x, int size_y,
+                 int row, int goal):
+    """Return the column of the goal-th free position in row."""
+    return _find_hit(integral_image, _NO_BITS, _NO_BITS, _NO_ROWS,
+                     _box(size_x, size_y), row, goal)
+
+
+def spiral_integral_image(unsigned int[:,:] integral_image, int size_x,
+                          int size_y, random_state):
+    """Walk an Archimedean spiral from a random start, return the first
+    free position or None.
+
+    The cost depends on how crowded the canvas is around the start, not on
+    its size. Free positions are not equally likely, and the spiral can
+    miss free positions far away from the start.
+    """
+    return _spiral(integral_image, _NO_BITS, _NO_BITS, _NO_ROWS,
+                   _box(size_x, size_y), random_state)
+
+
+def sprite_core(unsigned char[:,:] sprite):
+    """Find the largest solid rectangle in a boolean sprite.
+
+    Returns its first row and column and its size as
+    (core_i, core_j, core_x, core_y).
+    """
+    cdef int h = sprite.shape[0]
+    cdef int w = sprite.shape[1]
+    cdef int i, j, k, top, height, area
+    cdef int best = 0
+    cdef int best_i = 0, best_j = 0, best_x = 0, best_y = 0
+    # height of the column of set pixels ending in the current row, and a
+    # stack of columns with increasing heights
+    cdef int[:] heights = np.zeros(w + 1, dtype=np.intc)
+    cdef int[:] stack = np.zeros(w + 1, dtype=np.intc)
+    for i in range(h):
+        for j in range(w):
+            heights[j] = heights[j] + 1 if sprite[i, j] else 0
+        top = 0
+        for j in range(w + 1):
+            while top > 0 and heights[stack[top - 1]] >= heights[j]:
+                height = heights[stack[top - 1]]
+                top -= 1
+                k = stack[top - 1] + 1 if top > 0 else 0
+                area = height * (j - k)
+                if area > best:
+                    best = area
+                    best_i, best_j = i + 1 - height, k
+                    best_x, best_y = height, j - k
+            stack[top] = j
+            top += 1
+    return best_i, best_j, best_x, best_y
+
+
+def count_sprite_hits(unsigned int[:,:] integral_image,
+                      unsigned long long[:,:] bit_image,
+                      unsigned long long[:,:] sprite, int size_y, core,
+                      int[:] row_order, unsigned int[:] row_hits,
+                      bint coarse=True, int num_threads=1):
+    """Count the positions in each row where a sprite does not collide.
+
+    bit_image holds the occupancy of the canvas and sprite the pixels of
+    the word, both with 64 pixels packed per word, least significant bit
+    first. A position is free if no set pixel of the sprite falls on a set
+    pixel of the canvas. Positions whose whole box is free are accepted, and
+    positions where the core of the sprite (see sprite_core) is occupied are
+    rejected using the integral image, without looking at the sprite.
+    Otherwise the rows of the sprite are compared in the given row_order.
+    """
+    return _count_rows(integral_image, bit_image, sprite, row_order,
+                       _sprite_box(sprite, size_y, core), coarse, row_hits,
+                       num_threads)
+
+
+def find_sprite_hit(unsigned int[:,:] integral_image,
+                    unsigned long long[:,:] bit_image,
+                    unsigned long long[:,:] sprite, int size_y, core,
+                    int[:] row_order, int row, int goal):
+    """Return the column of the goal-th free sprite position in row."""
+    return _find_hit(integral_image, bit_image, sprite, row_order,
+                     _sprite_box(sprite, size_y, core), row, goal)
+
+
+def spiral_sprite_image(unsigned int[:,:] integral_image,
+                        unsigned long long[:,:] bit_image,
+                        unsigned long long[:,:] sprite, int size_y, core,
+                        int[:] row_order, random_state):
+    """Walk an Archimedean spiral to the first free sprite position."""
+    return _spiral(integral_image, bit_image, sprite, row_order,
+                   _sprite_box(sprite, size_y, core), random_state)
+
+
+def probe_sprite_image(unsigned int[:,:] integral_image,
+                       unsigned long long[:,:] bit_image,
+                       unsigned long long[:,:] sprite, int size_y, core,
+                       int[:] row_order, random_state, int n_probes):
+    """Try n_probes random sprite positions, return the first free one."""
+    cdef int x = integral_image.shape[0]
+    cdef int y = integral_image.shape[1]
+    cdef Box box = _sprite_box(sprite, size_y, core)
+    cdef int i, j, k
+    if x - box.size_x <= 0 or y - size_y <= 0:
+        return None
+    for k in range(n_probes):
+        i = random_state.randint(0, x - box.size_x - 1)
+        j = random_state.randint(0, y - size_y - 1)
+        if _free(integral_image, bit_image, sprite, row_order, box, i, j):
+            return i, j
+    return None
+
+
+cdef inline unsigned int _pixel(unsigned int[:,:] integral_image, int i,
+                                int j) nogil:
+    # value of pixel (i, j) of the image the integral image was built from
+    cdef unsigned int value = integral_image[i, j]
+    if i > 0:
+        value -= integral_image[i - 1, j]
+    if j > 0:
+        value -= integral_image[i, j - 1]
+        if i > 0:
+            value += integral_image[i - 1, j - 1]
+    return value
+
+
+def update_free_squares(unsigned int[:,:] integral_image, int[:,:] squares,
+                        int[:] row_max, int x0, int y0, int x1, int y1):
+    """Update the map of largest free squares after pixels changed.
+
+    squares[i, j] is the side of the largest free square whose top left
+    corner is (i, j), and row_max holds the maximum of each row. Pixels in
+    rows x0 .. x1 - 1 and columns y0 .. y1 - 1 may have changed. Changes
+    only propagate up and to the left, and only cells whose value actually
+    changes are followed, so the cost depends on how far the squares that
+    reach into the box extend.
+    """
+    cdef int x = squares.shape[0]
+    cdef int y = squares.shape[1]
+    cdef int i, j, lo, hi, lo_below, hi_below, value, below, right, diagonal
+    cdef int changed_lo, changed_hi
+    with nogil:
+        # columns that changed in the row below
+        lo_below, hi_below = y, -1
+        for i in range(x1 - 1, -1, -1):
+            lo, hi = y, -1
+            if i >= x0:
+                lo, hi = y0, y1 - 1
+            if hi_below >= 0:
+                # (i, j) depends on (i + 1, j) and (i + 1, j + 1)
+                lo = min(lo, lo_below - 1)
+                hi = max(hi, hi_below)
+            if hi < 0:
+                break
+            changed_lo, changed_hi = y, -1
+            j = hi
+            while j >= 0:
+                if _pixel(integral_image, i, j):
+                    value = 0
+                else:
+                    below = squares[i + 1, j] if i + 1 < x else 0
+                    right = squares[i, j + 1] if j + 1 < y else 0
+                    diagonal = (squares[i + 1, j + 1]
+                                if i + 1 < x and j + 1 < y else 0)
+                    value = 1 + min(below, right, diagonal)
+                if value != squares[i, j]:
+                    squares[i, j] = value
+                    changed_lo = j
+                    if changed_hi < 0:
+                        changed_hi = j
+                elif j < lo:
+                    # (i, j - 1) depends on (i, j), which did not change
+                    break
+                j -= 1
+            if changed_hi >= 0:
+                row_max[i] = 0
+                for j in range(y):
+                    if squares[i, j] > row_max[i]:
+                        row_max[i] = squares[i, j]
+            lo_below, hi_below = changed_lo, changed_hi
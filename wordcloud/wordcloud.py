@@ -10,25 +10,38 @@ from __future__ import division
 
 import warnings
 from random import Random
+import copy
+import gzip
 import io
+import time
+import types
 import os
 import re
 import base64
 import sys
 import colorsys
+from hashlib import sha1, sha256
 import matplotlib
 import numpy as np
 from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from xml.sax import saxutils
 
 from PIL import Image
 from PIL import ImageColor
 from PIL import ImageDraw
 from PIL import ImageFilter
-from PIL import ImageFont
 
-from .query_integral_image import query_integral_image
+from .query_integral_image import (probe_integral_image,
+                                   count_row_hits, find_row_hit,
+                                   count_sprite_hits, find_sprite_hit,
+                                   probe_sprite_image, sprite_core,
+                                   spiral_integral_image, spiral_sprite_image,
+                                   update_free_squares)
 from .tokenization import unigrams_and_bigrams, process_tokens
+from .fonts import get_font, get_transposed_font, TextMeasurements
+from ._version import __version__
 
 FILE = os.path.dirname(__file__)
 FONT_PATH = os.environ.get('FONT_PATH', os.path.join(FILE, 'DroidSansMono.ttf'))
@@ -36,22 +49,249 @@ with open(os.path.join(FILE, 'stopwords')) as f:
     STOPWORDS = set(map(str.strip, f.readlines()))
 
 
+def _pack_bits(mask, n_words):
+    """Pack the rows of a boolean array into n_words uint64 per row.
+
+    Pixels are packed least significant bit first.
+    """
+    packed = np.zeros((mask.shape[0], 8 * n_words), dtype=np.uint8)
+    row_bytes = np.packbits(mask, axis=1, bitorder='little')
+    packed[:, :row_bytes.shape[1]] = row_bytes
+    return packed.view('<u8').astype(np.uint64)
+
+
+def _dilate(mask, radius):
+    """Grow a boolean array by radius pixels in each direction."""
+    for axis in (0, 1):
+        grown = mask.copy()
+        for shift in range(1, radius + 1):
+            if axis == 0:
+                grown[shift:] |= mask[:-shift]
+                grown[:-shift] |= mask[shift:]
+            else:
+                grown[:, shift:] |= mask[:, :-shift]
+                grown[:, :-shift] |= mask[:, shift:]
+        mask = grown
+    return mask
+
+
 class IntegralOccupancyMap(object):
-    def __init__(self, height, width, mask):
+    def __init__(self, height, width, mask, max_probes=0, coarse=False,
+                 n_threads=1, glyph=False, placement="random"):
         self.height = height
         self.width = width
+        self.placement = placement
+        self.max_probes = max_probes
+        self.coarse = coarse
+        self.n_threads = n_threads
+        self._row_hits = np.zeros(height, dtype=np.uint32)
+        # free positions and free positions per row of the box sizes counted
+        # since the last update
+        self._counts = {}
+        # frontier of the smallest box sizes that did not fit
+        self._infeasible = []
         if mask is not None:
             # the order of the cumsum's is important for speed ?!
             self.integral = np.cumsum(np.cumsum(255 * mask, axis=1),
                                       axis=0).astype(np.uint32)
         else:
             self.integral = np.zeros((height, width), dtype=np.uint32)
+        self._scratch = None
+        # side of the largest free square starting at each pixel
+        self._squares = np.zeros((height, width), dtype=np.intc)
+        self._squares_row_max = np.zeros(height, dtype=np.intc)
+        update_free_squares(self.integral, self._squares,
+                            self._squares_row_max, 0, 0, height, width)
+        if glyph:
+            # occupancy of each pixel, bit-packed for sprite collisions
+            self.bits = _pack_bits(
+                mask if mask is not None else np.zeros((height, width), bool),
+                width // 64 + 2)
+        else:
+            self.bits = None
 
     def sample_position(self, size_x, size_y, random_state):
-        return query_integral_image(self.integral, size_x, size_y,
-                                    random_state)
+        if self.known_infeasible(size_x, size_y):
+            return None
+        if self.placement == "spiral":
+            return spiral_integral_image(self.integral, size_x, size_y,
+                                         random_state)
+        if self.max_probes > 0:
+            # cheap random probes first, most succeed on an empty canvas
+            result = probe_integral_image(self.integral, size_x, size_y,
+                                          random_state, self.max_probes)
+            if result is not None:
+                return result
+        return self._sample_row_hits(size_x, size_y, random_state)
+
+    def largest_free_square(self):
+        """Side of the largest square of free pixels on the canvas.
+
+        No box whose smaller side is larger than this can fit anywhere.
+        """
+        return int(self._squares_row_max.max())
+
+    def known_infeasible(self, size_x, size_y):
+        """Whether a box of this size is known not to fit anywhere.
 
-    def update(self, img_array, pos_x, pos_y):
+        Occupied pixels are never freed, so once a box does not fit, no box
+        that is at least as large in both directions will fit either.
+        """
+        if min(size_x, size_y) > self.largest_free_square():
+            return True
+        for infeasible_x, infeasible_y in self._infeasible:
+            if infeasible_x <= size_x and infeasible_y <= size_y:
+                return True
+        return False
+
+    def _add_infeasible(self, size_x, size_y):
+        # keep only the smallest infeasible sizes
+        self._infeasible = [(x, y) for x, y in self._infeasible
+                            if x < size_x or y < size_y]
+        self._infeasible.append((size_x, size_y))
+
+    def sample_sprite(self, sprite, random_state):
+        """Sample a position where the set pixels of sprite are free.
+
+        Only available if the map was created with glyph=True. The box of
+        the sprite may overlap other words, as long as no pixels collide.
+        """
+        size_x, size_y = sprite.shape
+        core = sprite_core(sprite.view(np.uint8))
+        row_order = np.argsort(-sprite.sum(axis=1), kind="stable").astype(np.intc)
+        sprite = _pack_bits(sprite, (size_y + 63) // 64)
+        if self.placement == "spiral":
+            return spiral_sprite_image(self.integral, self.bits, sprite,
+                                       size_y, core, row_order, random_state)
+        if self.max_probes > 0:
+            result = probe_sprite_image(self.integral, self.bits, sprite,
+                                        size_y, core, row_order, random_state,
+                                        self.max_probes)
+            if result is not None:
+                return result
+        hits = count_sprite_hits(self.integral, self.bits, sprite, size_y,
+                                 core, row_order, self._row_hits, self.coarse,
+                                 self.n_threads)
+        row, goal = self._choose_row(hits, self._row_hits, random_state)
+        if row is None:
+            return None
+        return row, find_sprite_hit(self.integral, self.bits, sprite, size_y,
+                                    core, row_order, row, goal)
+
+    def fits(self, size_x, size_y):
+        """Whether a box of this size fits anywhere on the canvas.
+
+        Unlike sample_position, this does not use any random numbers.
+        """
+        if self.known_infeasible(size_x, size_y):
+            return False
+        return self._count_row_hits(size_x, size_y)[0] > 0
+
+    def needs_scan(self, size_x, size_y):
+        """Whether the free positions for a box of this size are unknown."""
+        return ((size_x, size_y) not in self._counts
+                and not self.known_infeasible(size_x, size_y))
+
+    def count_sizes(self, sizes, executor):
+        """Count the free positions for several box sizes at the same time.
+
+        Each size that needs a scan is counted in a task of executor, with
+        the GIL released. The counts are kept until the next update, so
+        sample_position and fits do not scan the canvas again for these
+        sizes. No random numbers are used.
+        """
+        sizes = [size for size in dict.fromkeys(sizes)
+                 if self.needs_scan(*size)]
+        row_hits = [np.zeros(self.height, dtype=np.uint32) for _ in sizes]
+
+        def count(size, rows):
+            return count_row_hits(self.integral, size[0], size[1], rows,
+                                  self.coarse)
+
+        for size, hits, rows in zip(sizes,
+                                    executor.map(count, sizes, row_hits),
+                                    row_hits):
+            self._counts[size] = hits, rows
+
+    def _count_row_hits(self, size_x, size_y):
+        # the counts stay valid until the next update
+        if (size_x, size_y) not in self._counts:
+            row_hits = np.zeros(self.height, dtype=np.uint32)
+            hits = count_row_hits(self.integral, size_x, size_y, row_hits,
+                                  self.coarse, self.n_threads)
+            self._counts[size_x, size_y] = hits, row_hits
+        hits, row_hits = self._counts[size_x, size_y]
+        # sizes counted in advance only become known to be infeasible once
+        # they are used, so that probing uses the same random numbers
+        if not hits:
+            self._add_infeasible(size_x, size_y)
+        return hits, row_hits
+
+    def _sample_row_hits(self, size_x, size_y, random_state):
+        hits, row_hits = self._count_row_hits(size_x, size_y)
+        row, goal = self._choose_row(hits, row_hits, random_state)
+        if row is None:
+            return None
+        return row, find_row_hit(self.integral, size_x, size_y, row, goal)
+
+    def _choose_row(self, hits, row_hits, random_state):
+        # pick the same position as query_integral_image would, the goal-th
+        # free position in row major order (goal == 0 matches none).
+        # Returns the row and the index of the position within the row.
+        if not hits:
+            return None, None
+        goal = random_state.randint(0, hits)
+        if goal == 0:
+            return None, None
+        row_ends = np.cumsum(row_hits)
+        row = int(np.searchsorted(row_ends, goal))
+        if row > 0:
+            goal -= int(row_ends[row - 1])
+        return row, goal
+
+    def copy(self, **params):
+        """Copy of the map with the same occupied pixels.
+
+        Keyword arguments set max_probes, coarse, n_threads or placement of
+        the copy.
+        """
+        occupancy = copy.copy(self)
+        occupancy.integral = self.integral.copy()
+        occupancy._squares = self._squares.copy()
+        occupancy._squares_row_max = self._squares_row_max.copy()
+        if self.bits is not None:
+            occupancy.bits = self.bits.copy()
+        occupancy._row_hits = np.zeros_like(self._row_hits)
+        occupancy._counts = {}
+        occupancy._infeasible = list(self._infeasible)
+        occupancy._scratch = None
+        for name, value in params.items():
+            setattr(occupancy, name, value)
+        return occupancy
+
+    def update(self, img_array, pos_x, pos_y, size_x=None, size_y=None):
+        """Update the integral image after drawing into img_array.
+
+        If size_x and size_y are given, only the box
+        ``img_array[pos_x:pos_x + size_x, pos_y:pos_y + size_y]`` is assumed
+        to have changed. The summed area table of the box is then computed
+        in a scratch buffer and its difference to the old table is added to
+        the area below and to the right of the box, instead of recomputing
+        the cumulative sums over the whole bottom right of the canvas.
+        """
+        self._counts.clear()
+        if size_x is None or size_y is None:
+            size_x, size_y = self.height - pos_x, self.width - pos_y
+            self._update_bottom_right(img_array, pos_x, pos_y)
+        else:
+            self._update_box(img_array, pos_x, pos_y, size_x, size_y)
+        self._update_bits(img_array, pos_x, pos_y, size_x, size_y)
+        update_free_squares(self.integral, self._squares,
+                            self._squares_row_max, max(pos_x, 0),
+                            max(pos_y, 0), min(pos_x + size_x, self.height),
+                            min(pos_y + size_y, self.width))
+
+    def _update_bottom_right(self, img_array, pos_x, pos_y):
         partial_integral = np.cumsum(np.cumsum(img_array[pos_x:, pos_y:],
                                                axis=1), axis=0)
         # paste recomputed part into old image
@@ -67,6 +307,131 @@ class IntegralOccupancyMap(object):
 
         self.integral[pos_x:, pos_y:] = partial_integral
 
+    def _update_bits(self, img_array, pos_x, pos_y, size_x, size_y):
+        if self.bits is None:
+            return
+        x0, y0 = max(pos_x, 0), max(pos_y, 0)
+        x1 = min(pos_x + size_x, self.height)
+        y1 = min(pos_y + size_y, self.width)
+        if x1 <= x0 or y1 <= y0:
+            return
+        # repack the whole 64 pixel words touched by the box
+        w0, w1 = y0 // 64, (y1 - 1) // 64 + 1
+        self.bits[x0:x1, w0:w1] = _pack_bits(
+            img_array[x0:x1, 64 * w0:64 * w1] != 0, w1 - w0)
+
+    def _update_box(self, img_array, pos_x, pos_y, size_x, size_y):
+        x0, y0 = max(pos_x, 0), max(pos_y, 0)
+        x1 = min(pos_x + size_x, self.height)
+        y1 = min(pos_y + size_y, self.width)
+        if x1 <= x0 or y1 <= y0:
+            return
+        if self._scratch is None:
+            self._scratch = np.empty((self.height, self.width),
+                                     dtype=np.uint32)
+        integral = self.integral
+        # new integral image inside the box: summed area table of the box
+        # plus the (unchanged) integral values above and left of it.
+        # uint32 arithmetic wraps around, which cancels out in the end.
+        box = self._scratch[:x1 - x0, :y1 - y0]
+        np.cumsum(img_array[x0:x1, y0:y1], axis=1, dtype=np.uint32, out=box)
+        np.cumsum(box, axis=0, out=box)
+        if x0 > 0:
+            box += integral[x0 - 1, y0:y1]
+        if y0 > 0:
+            box += integral[x0:x1, y0 - 1][:, np.newaxis]
+            if x0 > 0:
+                box -= integral[x0 - 1, y0 - 1]
+        # everything below / right of the box changes by the same amount
+        # as the last row / column of the box
+        row_delta = box[-1] - integral[x1 - 1, y0:y1]
+        col_delta = box[:, -1] - integral[x0:x1, y1 - 1]
+        integral[x0:x1, y0:y1] = box
+        integral[x1:, y0:y1] += row_delta
+        integral[x0:x1, y1:] += col_delta[:, np.newaxis]
+        integral[x1:, y1:] += row_delta[-1]
+
+
+def _svg_color(color):
+    """Color as a string for SVG, which has no syntax for tuples."""
+    if isinstance(color, tuple):
+        return "rgb({}, {}, {})".format(*color[:3])
+    return color
+
+
+def _get_n_threads(n_jobs):
+    """Number of threads to use for n_jobs, with -1 meaning all processors."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def _color_func_key(color_func):
+    """Identify color_func for the layout cache, None if not possible.
+
+    Only colormaps and module level functions are known to always give the
+    same colors.
+    """
+    if isinstance(color_func, colormap_color_func):
+        return "colormap", color_func.colormap.name
+    if (isinstance(color_func, types.FunctionType)
+            and color_func.__closure__ is None
+            and "<" not in color_func.__qualname__):
+        return color_func.__module__, color_func.__qualname__
+    return None
+
+
+# digests of font files by path, size and modification time
+_file_digests = {}
+
+
+def _file_digest(path):
+    """SHA-256 digest of a file, remembered while it is not modified."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        with open(path, "rb") as f:
+            _file_digests[key] = sha256(f.read()).hexdigest()
+    return _file_digests[key]
+
+
+# word cloud used by the worker processes of WordCloud.generate_many
+_worker_wordcloud = None
+
+
+def _init_worker(wordcloud, mask_state, shared_arrays):
+    """Set up a worker process of WordCloud.generate_many.
+
+    The mask and the arrays of mask_state are mapped from shared memory.
+    """
+    global _worker_wordcloud
+    # keep the shared memory open as long as the arrays are used
+    wordcloud._shared_memory = []
+    arrays = {}
+    for key, (name, shape, dtype) in shared_arrays.items():
+        memory = shared_memory.SharedMemory(name=name)
+        wordcloud._shared_memory.append(memory)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    wordcloud.mask = arrays.pop("mask", None)
+    mask_state.attach_arrays(arrays)
+    wordcloud._mask_state = mask_state
+    _worker_wordcloud = wordcloud
+
+
+def _generate_one(item, seed, output):
+    """Lay out one item of WordCloud.generate_many in a worker process."""
+    wordcloud = _worker_wordcloud
+    wordcloud.random_state = Random(seed)
+    if isinstance(item, str):
+        wordcloud.generate_from_text(item)
+    else:
+        wordcloud.generate_from_frequencies(item)
+    if output == "image":
+        return wordcloud.to_image()
+    return wordcloud.layout_
+
 
 def random_color_func(word=None, font_size=None, position=None,
                       orientation=None, font_path=None, random_state=None):
@@ -89,6 +454,27 @@ def random_color_func(word=None, font_size=None, position=None,
     return "hsl(%d, 80%%, 50%%)" % random_state.randint(0, 255)
 
 
+# the colors of random_color_func for each hue
+_RANDOM_COLORS = np.array([ImageColor.getrgb("hsl(%d, 80%%, 50%%)" % hue)
+                           for hue in range(256)], dtype=np.uint8)
+
+
+def _random_color_batch(words, font_sizes, positions, orientations,
+                        font_path=None, random_state=None):
+    """Colors of random_color_func for several words at once.
+
+    Returns an array of shape (n_words, 3) with the same colors as calling
+    random_color_func for each word in turn with random_state.
+    """
+    if random_state is None:
+        random_state = Random()
+    hues = [random_state.randint(0, 255) for _ in words]
+    return _RANDOM_COLORS[hues]
+
+
+random_color_func.batch = _random_color_batch
+
+
 class colormap_color_func(object):
     """Color func created from matplotlib colormap.
 
@@ -114,6 +500,19 @@ class colormap_color_func(object):
             random_state.uniform(0, 1))))
         return "rgb({:.0f}, {:.0f}, {:.0f})".format(r, g, b)
 
+    def batch(self, words, font_sizes, positions, orientations,
+              font_path=None, random_state=None):
+        """Colors for several words at once.
+
+        Returns an array of shape (n_words, 3) with the same colors as
+        calling the color func for each word in turn with random_state.
+        """
+        if random_state is None:
+            random_state = Random()
+        values = [random_state.uniform(0, 1) for _ in words]
+        colors = np.maximum(0, 255 * self.colormap(values)[:, :3])
+        return np.rint(colors).astype(np.uint8).reshape(-1, 3)
+
 
 def get_single_color_func(color):
     """Create a color function which returns a single hue and saturation with.
@@ -149,9 +548,92 @@ def get_single_color_func(color):
         r, g, b = colorsys.hsv_to_rgb(h, s, random_state.uniform(0.2, 1))
         return 'rgb({:.0f}, {:.0f}, {:.0f})'.format(r * rgb_max, g * rgb_max,
                                                     b * rgb_max)
+
+    def batch(words, font_sizes, positions, orientations, font_path=None,
+              random_state=None):
+        """Colors of single_color_func for several words at once.
+
+        Returns an array of shape (n_words, 3) with the same colors as
+        calling single_color_func for each word in turn with random_state.
+        """
+        if random_state is None:
+            random_state = Random()
+        values = np.array([random_state.uniform(0.2, 1) for _ in words])
+        # hsv_to_rgb scales the channels of value 1 by the value
+        rgb = np.array(colorsys.hsv_to_rgb(h, s, 1.))
+        colors = np.outer(values, rgb) * rgb_max
+        return np.rint(colors).astype(np.uint8).reshape(-1, 3)
+
+    single_color_func.batch = batch
     return single_color_func
 
 
+# arrays of an empty IntegralOccupancyMap that are computed from the mask
+_OCCUPANCY_ARRAYS = ("integral", "_squares", "_squares_row_max", "bits")
+
+
+class _MaskState(object):
+    """Everything computed from the mask of a WordCloud for its layouts.
+
+    The boolean mask, a digest of the mask and the occupied pixels are
+    computed when the state is created. Empty occupancy maps, with the
+    integral image and free squares of the mask, are created when first
+    needed and copied for each layout.
+    """
+    def __init__(self, mask, boolean_mask):
+        self.boolean_mask = boolean_mask
+        if mask is not None:
+            contiguous = np.ascontiguousarray(mask)
+            digest = sha1(repr((mask.shape, mask.dtype.str)).encode("utf-8"))
+            digest.update(contiguous.tobytes())
+            self.digest = digest.digest()
+            self.occupied = np.zeros(mask.shape[:2], dtype=np.uint8)
+            self.occupied[boolean_mask] = 255
+        else:
+            self.digest = None
+            self.occupied = None
+        # empty occupancy maps by canvas size and glyph collisions
+        self._occupancy = {}
+
+    def empty_occupancy(self, height, width, glyph):
+        """Occupancy map with only the mask occupied, to be copied."""
+        key = (height, width, glyph)
+        if key not in self._occupancy:
+            self._occupancy[key] = IntegralOccupancyMap(
+                height, width, self.boolean_mask, glyph=glyph)
+        return self._occupancy[key]
+
+    def detach_arrays(self):
+        """Copy of the state without its arrays, and the arrays by key.
+
+        The arrays can be put in shared memory and given to the copy with
+        attach_arrays in another process, which then does not compute them
+        again.
+        """
+        state = copy.copy(self)
+        arrays = {"boolean_mask": self.boolean_mask,
+                  "occupied": self.occupied}
+        state.boolean_mask = state.occupied = None
+        state._occupancy = {}
+        for key, occupancy in self._occupancy.items():
+            empty = copy.copy(occupancy)
+            for name in _OCCUPANCY_ARRAYS:
+                arrays[key + (name,)] = getattr(occupancy, name)
+                setattr(empty, name, None)
+            state._occupancy[key] = empty
+        arrays = {key: array for key, array in arrays.items()
+                  if array is not None}
+        return state, arrays
+
+    def attach_arrays(self, arrays):
+        """Give back the arrays returned by detach_arrays."""
+        self.boolean_mask = arrays.get("boolean_mask")
+        self.occupied = arrays.get("occupied")
+        for key, occupancy in self._occupancy.items():
+            for name in _OCCUPANCY_ARRAYS:
+                setattr(occupancy, name, arrays.get(key + (name,)))
+
+
 class WordCloud(object):
     r"""Word cloud object for generating and drawing.
 
@@ -179,7 +661,8 @@ class WordCloud(object):
         None, width and height will be ignored and the shape of mask will be
         used instead. All white (#FF or #FFFFFF) entries will be considerd
         "masked out" while other entries will be free to draw on. [This
-        changed in the most recent version!]
+        changed in the most recent version!] The mask is preprocessed once
+        for all layouts; after changing it in place, assign it again.
 
     contour_width: float (default=0)
         If mask is not None and contour_width > 0, draw the mask contour.
@@ -200,6 +683,81 @@ class WordCloud(object):
         Step size for the font. font_step > 1 might speed up computation but
         give a worse fit.
 
+    max_probes : int (default=0)
+        Number of random positions to test for a word before falling back to
+        scanning the whole canvas for free positions. Each test is O(1), so
+        this makes placing words on a mostly empty canvas much faster. Words
+        are still placed uniformly at random among the free positions, but
+        the layout for a given random_state changes. 0 disables probing.
+
+    coarse_search : bool (default=False)
+        Whether to search for free positions coarse-to-fine. Blocks of
+        positions that are entirely blocked (or entirely free) are detected
+        at a low resolution and are not scanned. This is much faster on
+        canvases that are mostly masked out or already full, and gives the
+        same layout as the full scan.
+
+    n_jobs : int or None (default=None)
+        Number of threads used to scan the canvas for free positions. None
+        means 1, -1 means using all processors. The scan releases the GIL
+        and gives the same layout for any number of threads. Requires the
+        extension to be built with OpenMP.
+
+    collision : {"bbox", "glyph"} (default="bbox")
+        How words collide. With "bbox", the whole bounding box of a word
+        (plus margin) must be free. With "glyph", only the rendered pixels of
+        the word, grown by half the margin, must be free, so words can nest
+        in the gaps of other words.
+
+    placement : {"random", "spiral"} (default="random")
+        Where to put a word. With "random", a position is drawn uniformly
+        among all free positions. With "spiral", the word is put at the
+        first free position on an Archimedean spiral around a random point
+        near the center of the canvas, like d3-cloud does.
+
+    font_size_search : {"linear", "bisect"} (default="linear")
+        How to find a smaller font size for a word that does not fit. With
+        "linear", the font size is lowered by font_step and the canvas is
+        scanned again until the word fits. With "bisect", the largest font
+        size that fits is found by bisection, which needs a logarithmic
+        number of scans. Both give the same layout for
+        ``collision="bbox"`` and ``max_probes=0``, assuming text does not
+        get larger with a smaller font. Glyph collisions always use
+        "linear".
+
+    time_budget : float or None (default=None)
+        Maximum time in seconds for placing the words in
+        generate_from_frequencies. When it runs out, the words that were not
+        placed yet are skipped, and ``layout_`` contains the words placed so
+        far. The number of skipped words is stored in ``n_words_skipped_``.
+        If max_font_size is None, the budget includes estimating it, and no
+        word is placed if that runs out of time. Copying the empty canvas
+        for a layout is not bounded and takes time proportional to its size.
+        None means no limit.
+
+    layout_cache : LayoutCache or None (default=None)
+        On-disk cache of layouts. If random_state is set,
+        generate_from_frequencies first looks up a layout for the same
+        frequencies, parameters, mask, font file and random state, and
+        stores the layouts it computes. color_func must be a module level
+        function or come from colormap for layouts to be cached. Layouts cut
+        short by time_budget are not stored.
+
+    speculative : bool (default=False)
+        Whether to scan the canvas for the next font sizes and orientations
+        of a word that does not fit at the same time, on n_jobs threads,
+        instead of one after the other. The first of them that fits in the
+        serial order is used, so the layout does not change. Only used with
+        ``collision="bbox"`` and ``placement="random"``, and if n_jobs gives
+        more than one thread, so set n_jobs as well.
+
+    keep_sprites : bool (default=False)
+        Whether to keep the rendering of each word from the layout, so that
+        to_image only needs to composite them with their colors. This makes
+        to_image after recolor much faster, at the cost of memory. With
+        scale != 1, the words are rendered again once, at the first call to
+        to_image.
+
     max_words : number (default=200)
         The maximum number of words.
 
@@ -239,6 +797,12 @@ class WordCloud(object):
         ``color_func=lambda *args, **kwargs: "white"``.
         The single color can also be specified using RGB code. For example
         ``color_func=lambda *args, **kwargs: (255,0,0)`` sets color to red.
+        If color_func has a ``batch`` attribute, recolor calls
+        ``color_func.batch(words, font_sizes, positions, orientations,
+        font_path, random_state)`` once with a list of words, arrays of font
+        sizes and positions and a list of orientations, which returns the
+        colors as an (n_words, 3) uint8 array. The color functions in this
+        module support it, and give the same colors either way.
 
     regexp : string or None (optional)
         Regular expression to split the input text into tokens in process_text.
@@ -295,7 +859,12 @@ class WordCloud(object):
         Encodes the fitted word cloud. For each word, it encodes the string,
         normalized frequency, font size, position, orientation, and color.
         The frequencies are normalized by the most commonly occurring word.
-        The color is in the format of 'rgb(R, G, B).'
+        The color is in the format of 'rgb(R, G, B)', or an (r, g, b) tuple
+        after a recolor with a color_func that has a ``batch`` attribute,
+        like the default one.
+
+    ``n_words_skipped_`` : int
+        Number of words that were not placed because time_budget ran out.
 
     Notes
     -----
@@ -315,7 +884,11 @@ class WordCloud(object):
                  relative_scaling='auto', regexp=None, collocations=True,
                  colormap=None, normalize_plurals=True, contour_width=0,
                  contour_color='black', repeat=False,
-                 include_numbers=False, min_word_length=0, collocation_threshold=30):
+                 include_numbers=False, min_word_length=0, collocation_threshold=30,
+                 max_probes=0, coarse_search=False, n_jobs=None,
+                 collision="bbox", placement="random",
+                 font_size_search="linear", time_budget=None,
+                 layout_cache=None, speculative=False, keep_sprites=False):
         if font_path is None:
             font_path = FONT_PATH
         if color_func is None and colormap is None:
@@ -340,6 +913,36 @@ class WordCloud(object):
         self.stopwords = stopwords if stopwords is not None else STOPWORDS
         self.min_font_size = min_font_size
         self.font_step = font_step
+        self.max_probes = max_probes
+        self.coarse_search = coarse_search
+        if n_jobs == 0:
+            raise ValueError("n_jobs needs to be a nonzero integer or None, "
+                             "got 0.")
+        self.n_jobs = n_jobs
+        if collision not in ("bbox", "glyph"):
+            raise ValueError("collision needs to be 'bbox' or 'glyph', got %r."
+                             % collision)
+        self.collision = collision
+        if placement not in ("random", "spiral"):
+            raise ValueError("placement needs to be 'random' or 'spiral', "
+                             "got %r." % placement)
+        self.placement = placement
+        if font_size_search not in ("linear", "bisect"):
+            raise ValueError("font_size_search needs to be 'linear' or "
+                             "'bisect', got %r." % font_size_search)
+        self.font_size_search = font_size_search
+        self.time_budget = time_budget
+        self.layout_cache = layout_cache
+        self.speculative = speculative
+        self.keep_sprites = keep_sprites
+        # rendered words by word, font path, font size and orientation
+        self._sprites = {}
+        # contour of the mask for to_image, with the parameters it is for
+        self._contour = None
+        # measured text sizes, kept across calls to generate
+        self._measurements = TextMeasurements()
+        # font sizes estimated for max_font_size=None
+        self._max_font_sizes = {}
         self.regexp = regexp
         if isinstance(random_state, int):
             random_state = Random(random_state)
@@ -389,7 +992,7 @@ class WordCloud(object):
         """
         return self.generate_from_frequencies(frequencies)
 
-    def generate_from_frequencies(self, frequencies, max_font_size=None):  # noqa: C901
+    def generate_from_frequencies(self, frequencies, max_font_size=None):
         """Create a word_cloud from words and frequencies.
 
         Parameters
@@ -405,38 +1008,196 @@ class WordCloud(object):
         self
 
         """
-        # make sure frequencies are sorted and normalized
-        frequencies = sorted(frequencies.items(), key=itemgetter(1), reverse=True)
-        if len(frequencies) <= 0:
-            raise ValueError("We need at least 1 word to plot a word cloud, "
-                             "got %d." % len(frequencies))
-        frequencies = frequencies[:self.max_words]
+        for _ in self.iter_layout(frequencies, max_font_size):
+            pass
+        return self
 
-        # largest entry will be 1
-        max_frequency = float(frequencies[0][1])
+    def iter_layout(self, frequencies, max_font_size=None):
+        """Create a word_cloud from words and frequencies, word by word.
+
+        Like generate_from_frequencies, but a generator that yields each
+        word as soon as it is placed. ``layout_`` contains the words placed
+        so far, so a partial word cloud can be drawn while iterating. If
+        the iteration is stopped early, the layout stays partial.
+
+        Parameters
+        ----------
+        frequencies : dict from string to float
+            A contains words and associated frequency.
 
-        frequencies = [(word, freq / max_frequency)
-                       for word, freq in frequencies]
+        max_font_size : int
+            Use this font-size instead of self.max_font_size
 
+        Yields
+        ------
+        placement : tuple ((string, float), int, (int, int), int, color)
+            The word and its frequency, font size, position, orientation
+            and color, like the entries of ``layout_``.
+        """
+        key = self._layout_cache_key(frequencies, max_font_size)
+        if key is not None:
+            cached = self.layout_cache.get(key)
+            if cached is not None:
+                self._load_layout(cached)
+                for placement in list(self.layout_):
+                    yield placement
+                return
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.perf_counter() + self.time_budget
+        # closing this generator closes the layout as well
+        yield from self._iter_layout(frequencies, max_font_size,
+                                     self.font_size_search, deadline)
+        if key is not None and not self.n_words_skipped_:
+            self.layout_cache.put(key, self._dump_layout())
+
+    def _layout_cache_key(self, frequencies, max_font_size):
+        """Hash of everything a layout depends on, None if not cacheable."""
+        if self.layout_cache is None or self.random_state is None:
+            return None
+        color_func = _color_func_key(self.color_func)
+        if color_func is None:
+            return None
+        key = sha256()
+        for part in (__version__, sorted(frequencies.items()), max_font_size,
+                     self.width, self.height, self.margin,
+                     self.prefer_horizontal, self.min_font_size,
+                     self.max_font_size, self.font_step, self.max_words,
+                     self.relative_scaling, self.repeat, self.collision,
+                     self.placement, self.max_probes, self.font_size_search,
+                     color_func, _file_digest(self.font_path),
+                     self.random_state.getstate()):
+            key.update(repr(part).encode("utf-8"))
+        if self.mask is not None:
+            key.update(self._get_mask_state().digest)
+        return key.hexdigest()
+
+    def _dump_layout(self):
+        """JSON serializable copy of the layout and random state."""
+        layout = [[word, freq, font_size, [int(x), int(y)],
+                   None if orientation is None else int(orientation),
+                   color]
+                  for (word, freq), font_size, (x, y), orientation, color
+                  in self.layout_]
+        version, state, gauss_next = self.random_state.getstate()
+        return {"words": list(self.words_.items()), "layout": layout,
+                "random_state": [version, list(state), gauss_next]}
+
+    def _load_layout(self, cached):
+        """Restore the layout and random state stored by _dump_layout."""
+        self.words_ = dict(cached["words"])
+        self.layout_ = [
+            ((word, freq), font_size, tuple(position),
+             None if orientation is None else Image.Transpose(orientation),
+             tuple(color) if isinstance(color, list) else color)
+            for word, freq, font_size, position, orientation, color
+            in cached["layout"]]
+        self.n_words_skipped_ = 0
+        self._prune_sprites()
+        version, state, gauss_next = cached["random_state"]
+        self.random_state.setstate((version, tuple(state), gauss_next))
+
+    def update_from_frequencies(self, frequencies, layout=None):
+        """Update a word cloud for new frequencies, keeping unchanged words.
+
+        Words of the previous layout keep their position, orientation and
+        color if they are still among the max_words most frequent words and
+        get the same font size as before. The other words are placed around
+        them like in generate_from_frequencies. This is much faster than a
+        new layout if the frequencies changed only slightly, and keeps the
+        word cloud stable.
+
+        Font sizes start from max_font_size, or the size of the largest word
+        in the previous layout if max_font_size is None, and follow
+        relative_scaling from the previous word. The canvas and mask should
+        be the same as for the previous layout.
+
+        Parameters
+        ----------
+        frequencies : dict from string to float
+            A contains words and associated frequency.
+
+        layout : list or None (default=None)
+            Previous layout to update, in the format of ``layout_``. If None,
+            ``layout_`` of this word cloud is used.
+
+        Returns
+        -------
+        self
+        """
+        if layout is None:
+            self._check_generated()
+            layout = self.layout_
+        if not layout:
+            return self.generate_from_frequencies(frequencies)
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.perf_counter() + self.time_budget
+        frequencies = self._normalize_frequencies(frequencies)
         if self.random_state is not None:
             random_state = self.random_state
         else:
             random_state = Random()
+        self.words_ = dict(frequencies)
+        frequencies = self._repeat_frequencies(frequencies)
+
+        placements = self._keep_placements(frequencies, layout)
+        occupancy, occupied = self._empty_canvas()
+        for (word, _), font_size, position, orientation, _ in placements:
+            if position is not None:
+                self._draw_word(occupancy, occupied, word, font_size,
+                                orientation, *position)
+
+        # place the new words, largest first
+        n_skipped = 0
+        executor = self._candidate_pool()
+        for index, placement in enumerate(placements):
+            (word, _), font_size, position, _, _ = placement
+            if position is not None:
+                continue
+            font_size, orientation, position = self._place_word(
+                word, font_size, occupancy, random_state,
+                self.font_size_search, deadline, executor)
+            if position is None:
+                if font_size >= self.min_font_size:
+                    # out of time, skip the remaining new words
+                    n_skipped = sum(1 for placement in placements[index:]
+                                    if placement[2] is None)
+                # like a new layout, no smaller word is tried after the
+                # canvas is full
+                break
+            color = self.color_func(word, font_size=font_size,
+                                    position=position,
+                                    orientation=orientation,
+                                    random_state=random_state,
+                                    font_path=self.font_path)
+            placement[1:] = [font_size, position, orientation, color]
+            self._draw_word(occupancy, occupied, word, font_size, orientation,
+                            *position)
+        if executor is not None:
+            executor.shutdown()
+
+        self.layout_ = [tuple(placement) for placement in placements
+                        if placement[2] is not None]
+        self.n_words_skipped_ = n_skipped
+        self._prune_sprites()
+        return self
 
-        if self.mask is not None:
-            boolean_mask = self._get_bolean_mask(self.mask)
-            width = self.mask.shape[1]
-            height = self.mask.shape[0]
-        else:
-            boolean_mask = None
-            height, width = self.height, self.width
-        occupancy = IntegralOccupancyMap(height, width, boolean_mask)
+    def _generate_from_frequencies(self, frequencies, max_font_size,
+                                   font_size_search, deadline=None):
+        for _ in self._iter_layout(frequencies, max_font_size,
+                                   font_size_search, deadline):
+            pass
+        return self
 
-        # create image
-        img_grey = Image.new("L", (width, height))
-        draw = ImageDraw.Draw(img_grey)
-        img_array = np.asarray(img_grey)
-        font_sizes, positions, orientations, colors = [], [], [], []
+    def _iter_layout(self, frequencies, max_font_size, font_size_search,
+                     deadline=None):
+        frequencies = self._normalize_frequencies(frequencies)
+
+        if self.random_state is not None:
+            random_state = self.random_state
+        else:
+            random_state = Random()
 
         last_freq = 1.
 
@@ -451,23 +1212,8 @@ class WordCloud(object):
                 # we only have one word. We make it big!
                 font_size = self.height
             else:
-                self.generate_from_frequencies(dict(frequencies[:2]),
-                                               max_font_size=self.height)
-                # find font sizes
-                sizes = [x[1] for x in self.layout_]
-                try:
-                    font_size = int(2 * sizes[0] * sizes[1]
-                                    / (sizes[0] + sizes[1]))
-                # quick fix for if self.layout_ contains less than 2 values
-                # on very small images it can be empty
-                except IndexError:
-                    try:
-                        font_size = sizes[0]
-                    except IndexError:
-                        raise ValueError(
-                            "Couldn't find space to draw. Either the Canvas size"
-                            " is too small or too much of the image is masked "
-                            "out.")
+                font_size = self._estimate_max_font_size(
+                    frequencies, random_state, deadline)
         else:
             font_size = max_font_size
 
@@ -475,86 +1221,54 @@ class WordCloud(object):
         # above... hurray for good design?
         self.words_ = dict(frequencies)
 
-        if self.repeat and len(frequencies) < self.max_words:
-            # pad frequencies with repeating words.
-            times_extend = int(np.ceil(self.max_words / len(frequencies))) - 1
-            # get smallest frequency
-            frequencies_org = list(frequencies)
-            downweight = frequencies[-1][1]
-            for i in range(times_extend):
-                frequencies.extend([(word, freq * downweight ** (i + 1))
-                                    for word, freq in frequencies_org])
+        frequencies = self._repeat_frequencies(frequencies)
 
         # start drawing grey image
-        for word, freq in frequencies:
-            if freq == 0:
-                continue
-            # select the font size
-            rs = self.relative_scaling
-            if rs != 0:
-                font_size = int(round((rs * (freq / float(last_freq))
-                                       + (1 - rs)) * font_size))
-            if random_state.random() < self.prefer_horizontal:
-                orientation = None
-            else:
-                orientation = Image.ROTATE_90
-            tried_other_orientation = False
-            while True:
-                if font_size < self.min_font_size:
-                    # font-size went too small
-                    break
-                # try to find a position
-                font = ImageFont.truetype(self.font_path, font_size)
-                # transpose font optionally
-                transposed_font = ImageFont.TransposedFont(
-                    font, orientation=orientation)
-                # get size of resulting text
-                box_size = draw.textbbox((0, 0), word, font=transposed_font, anchor="lt")
-                # find possible places using integral image:
-                result = occupancy.sample_position(box_size[3] + self.margin,
-                                                   box_size[2] + self.margin,
-                                                   random_state)
-                if result is not None:
-                    # Found a place
+        self.layout_ = []
+        self.n_words_skipped_ = n_skipped = 0
+        if font_size is None:
+            # out of time while estimating max_font_size, skip all words
+            self.n_words_skipped_ = sum(1 for _, freq in frequencies
+                                        if freq != 0)
+            return
+        occupancy, occupied = self._empty_canvas()
+        executor = self._candidate_pool()
+        try:
+            for index, (word, freq) in enumerate(frequencies):
+                if freq == 0:
+                    continue
+                # select the font size
+                font_size = self._scale_font_size(font_size, freq / last_freq)
+                font_size, orientation, position = self._place_word(
+                    word, font_size, occupancy, random_state, font_size_search,
+                    deadline, executor)
+                if position is None:
+                    if font_size >= self.min_font_size:
+                        # out of time, skip this and all remaining words
+                        n_skipped = sum(1 for _, freq in frequencies[index:]
+                                        if freq != 0)
+                    # we were unable to draw any more
                     break
-                # if we didn't find a place, make font smaller
-                # but first try to rotate!
-                if not tried_other_orientation and self.prefer_horizontal < 1:
-                    orientation = (Image.ROTATE_90 if orientation is None else
-                                   Image.ROTATE_90)
-                    tried_other_orientation = True
-                else:
-                    font_size -= self.font_step
-                    orientation = None
-
-            if font_size < self.min_font_size:
-                # we were unable to draw any more
-                break
-
-            x, y = np.array(result) + self.margin // 2
-            # actually draw the text
-            draw.text((y, x), word, fill="white", font=transposed_font)
-            positions.append((x, y))
-            orientations.append(orientation)
-            font_sizes.append(font_size)
-            colors.append(self.color_func(word, font_size=font_size,
-                                          position=(x, y),
-                                          orientation=orientation,
-                                          random_state=random_state,
-                                          font_path=self.font_path))
-            # recompute integral image
-            if self.mask is None:
-                img_array = np.asarray(img_grey)
-            else:
-                img_array = np.asarray(img_grey) + boolean_mask
-            # recompute bottom right
-            # the order of the cumsum's is important for speed ?!
-            occupancy.update(img_array, x, y)
-            last_freq = freq
 
-        self.layout_ = list(zip(frequencies, font_sizes, positions,
-                                orientations, colors))
-        return self
+                x, y = position
+                color = self.color_func(word, font_size=font_size,
+                                        position=(x, y),
+                                        orientation=orientation,
+                                        random_state=random_state,
+                                        font_path=self.font_path)
+                self._draw_word(occupancy, occupied, word, font_size,
+                                orientation, x, y)
+                last_freq = freq
+                placement = ((word, freq), font_size, (x, y), orientation,
+                             color)
+                self.layout_.append(placement)
+                yield placement
+            self.n_words_skipped_ = n_skipped
+        finally:
+            # also when the generator is closed before the end
+            if executor is not None:
+                executor.shutdown()
+            self._prune_sprites()
 
     def process_text(self, text):
         """Splits a long text into words, eliminates the stopwords.
@@ -642,6 +1356,101 @@ class WordCloud(object):
         """
         return self.generate_from_text(text)
 
+    def generate_many(self, items, max_workers=None, output="layout"):
+        """Generate word clouds for many texts in a pool of processes.
+
+        Each item is laid out like ``generate`` would, by a copy of this word
+        cloud in a worker process. The worker processes keep their copy, so
+        fonts and measurements are loaded once per process. The mask is
+        preprocessed once, and the mask and the arrays computed from it are
+        shared with the workers through shared memory instead of being
+        copied or computed again.
+
+        Parameters
+        ----------
+        items : iterable of string or dict from string to float
+            Texts, passed to generate_from_text, or frequencies, passed to
+            generate_from_frequencies.
+
+        max_workers : int or None (default=None)
+            Number of worker processes. None means the number of processors.
+
+        output : {"layout", "image"} (default="layout")
+            Whether to return the ``layout_`` of each word cloud or the
+            image returned by ``to_image``.
+
+        Returns
+        -------
+        results : list
+            Layouts or images, in the order of items. The random seed of each
+            item is drawn from random_state, so the results are reproducible
+            for a fixed random_state. ``layout_`` of this word cloud is not
+            changed.
+
+        Notes
+        -----
+        color_func must be picklable, for example a module level function.
+        """
+        if output not in ("layout", "image"):
+            raise ValueError("output needs to be 'layout' or 'image', got %r."
+                             % output)
+        items = list(items)
+        if self.random_state is not None:
+            random_state = self.random_state
+        else:
+            random_state = Random()
+        seeds = [random_state.randint(0, 2 ** 32 - 1) for _ in items]
+
+        # preprocess the mask once, and share the mask and the arrays
+        # computed from it with the workers
+        mask_state = self._get_mask_state()
+        mask_state.empty_occupancy(*self._canvas_shape(),
+                                   glyph=self.collision == "glyph")
+        mask_state, arrays = mask_state.detach_arrays()
+        if self.mask is not None:
+            arrays["mask"] = self.mask
+        wordcloud = copy.copy(self)
+        wordcloud.mask = None
+        shared = []
+        try:
+            shared_arrays = {}
+            for key, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                memory = shared_memory.SharedMemory(
+                    create=True, size=max(array.nbytes, 1))
+                shared.append(memory)
+                np.ndarray(array.shape, dtype=array.dtype,
+                           buffer=memory.buf)[...] = array
+                shared_arrays[key] = (memory.name, array.shape, array.dtype)
+            with ProcessPoolExecutor(
+                    max_workers, initializer=_init_worker,
+                    initargs=(wordcloud, mask_state, shared_arrays)) as pool:
+                return list(pool.map(_generate_one, items, seeds,
+                                     [output] * len(items)))
+        finally:
+            for memory in shared:
+                memory.close()
+                memory.unlink()
+
+    @property
+    def mask(self):
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        self._mask = mask
+        # computed from the mask when first needed
+        self._mask_state = None
+
+    def _get_mask_state(self):
+        """State computed from the mask, kept until a new mask is assigned."""
+        if self._mask_state is None:
+            boolean_mask = None
+            if self.mask is not None:
+                boolean_mask = self._get_bolean_mask(self.mask)
+            self._mask_state = _MaskState(self.mask, boolean_mask)
+        return self._mask_state
+
     def _check_generated(self):
         """Check if ``layout_`` was computed, otherwise raise error."""
         if not hasattr(self, "layout_"):
@@ -659,15 +1468,13 @@ class WordCloud(object):
         img = Image.new(self.mode, (int(width * self.scale),
                                     int(height * self.scale)),
                         self.background_color)
-        draw = ImageDraw.Draw(img)
         for (word, count), font_size, position, orientation, color in self.layout_:
-            font = ImageFont.truetype(self.font_path,
-                                      int(font_size * self.scale))
-            transposed_font = ImageFont.TransposedFont(
-                font, orientation=orientation)
+            sprite = self._word_sprite(word, int(font_size * self.scale),
+                                       orientation)
             pos = (int(position[1] * self.scale),
                    int(position[0] * self.scale))
-            draw.text(pos, word, fill=color, font=transposed_font)
+            # same pixels as drawing the text with fill=color
+            img.paste(color, pos, sprite)
 
         return self._draw_contour(img=img)
 
@@ -685,7 +1492,9 @@ class WordCloud(object):
 
         color_func : function or None, default=None
             Function to generate new color from word count, font size, position
-            and orientation.  If None, self.color_func is used.
+            and orientation.  If None, self.color_func is used. If it has a
+            ``batch`` attribute, the colors of all words are computed with a
+            single call to it instead, see ``color_func`` of WordCloud.
 
         colormap : string or matplotlib colormap, default=None
             Use this colormap to generate new colors. Ignored if color_func
@@ -704,13 +1513,28 @@ class WordCloud(object):
                 color_func = self.color_func
             else:
                 color_func = colormap_color_func(colormap)
-        self.layout_ = [(word_freq, font_size, position, orientation,
-                         color_func(word=word_freq[0], font_size=font_size,
-                                    position=position, orientation=orientation,
-                                    random_state=random_state,
-                                    font_path=self.font_path))
-                        for word_freq, font_size, position, orientation, _
-                        in self.layout_]
+        if hasattr(color_func, "batch"):
+            # all colors at once, as (r, g, b) tuples
+            words = [word for (word, _), _, _, _, _ in self.layout_]
+            font_sizes = np.array([entry[1] for entry in self.layout_],
+                                  dtype=int)
+            positions = np.array([entry[2] for entry in self.layout_],
+                                 dtype=int).reshape(-1, 2)
+            orientations = [entry[3] for entry in self.layout_]
+            colors = color_func.batch(words, font_sizes, positions,
+                                      orientations, font_path=self.font_path,
+                                      random_state=random_state)
+            colors = [tuple(color) for color in colors.tolist()]
+        else:
+            colors = [color_func(word=word_freq[0], font_size=font_size,
+                                 position=position, orientation=orientation,
+                                 random_state=random_state,
+                                 font_path=self.font_path)
+                      for word_freq, font_size, position, orientation, _
+                      in self.layout_]
+        self.layout_ = [(word_freq, font_size, position, orientation, color)
+                        for (word_freq, font_size, position, orientation, _),
+                        color in zip(self.layout_, colors)]
         return self
 
     def to_file(self, filename):
@@ -794,7 +1618,52 @@ class WordCloud(object):
         content : string
             Word cloud image as SVG string
         """
+        elements = self._svg_elements(embed_font, optimize_embedded_font,
+                                      embed_image)
+        return '\n'.join(elements)
+
+    def write_svg(self, fileobj, embed_font=False, optimize_embedded_font=True,
+                  embed_image=False, compress=False):
+        """Export to SVG, writing it to a file as it is generated.
+
+        Unlike to_svg, the SVG document is never held in memory as a whole.
+        The output is the same as the one of to_svg.
+
+        Parameters
+        ----------
+        fileobj : file object or string
+            File object opened in binary mode, or the path of the file to
+            write to.
 
+        embed_font, optimize_embedded_font, embed_image
+            See to_svg.
+
+        compress : bool, default=False
+            Whether to compress the output with gzip, as used by .svgz
+            files.
+
+        Returns
+        -------
+        self
+        """
+        self._check_generated()
+        if isinstance(fileobj, (str, os.PathLike)):
+            with open(fileobj, "wb") as f:
+                return self.write_svg(f, embed_font, optimize_embedded_font,
+                                      embed_image, compress)
+        if compress:
+            with gzip.GzipFile(fileobj=fileobj, mode="wb") as f:
+                return self.write_svg(f, embed_font, optimize_embedded_font,
+                                      embed_image)
+        separator = b""
+        for element in self._svg_elements(embed_font, optimize_embedded_font,
+                                          embed_image):
+            fileobj.write(separator + element.encode("utf-8"))
+            separator = b"\n"
+        return self
+
+    def _svg_elements(self, embed_font, optimize_embedded_font, embed_image):
+        """Generate the elements of the SVG document, see to_svg."""
         # TODO should add option to specify URL for font (i.e. WOFF file)
 
         # Make sure layout is generated
@@ -813,11 +1682,8 @@ class WordCloud(object):
         else:
             max_font_size = self.max_font_size
 
-        # Text buffer
-        result = []
-
         # Get font information
-        font = ImageFont.truetype(self.font_path, int(max_font_size * self.scale))
+        font = get_font(self.font_path, int(max_font_size * self.scale))
         raw_font_family, raw_font_style = font.getname()
         # TODO properly escape/quote this name?
         font_family = repr(raw_font_family)
@@ -835,7 +1701,7 @@ class WordCloud(object):
             font_style = 'normal'
 
         # Add header
-        result.append(
+        yield (
             '<svg'
             ' xmlns="http://www.w3.org/2000/svg"'
             ' width="{}"'
@@ -888,7 +1754,7 @@ class WordCloud(object):
             woff.save(buffer)
             data = base64.b64encode(buffer.getbuffer()).decode('ascii')
             url = 'data:application/font-woff;charset=utf-8;base64,' + data
-            result.append(
+            yield (
                 '<style>'
                 '@font-face{{'
                 'font-family:{};'
@@ -906,7 +1772,7 @@ class WordCloud(object):
             )
 
         # Select global style
-        result.append(
+        yield (
             '<style>'
             'text{{'
             'font-family:{};'
@@ -923,7 +1789,7 @@ class WordCloud(object):
 
         # Add background
         if self.background_color is not None:
-            result.append(
+            yield (
                 '<rect'
                 ' width="100%"'
                 ' height="100%"'
@@ -939,7 +1805,7 @@ class WordCloud(object):
             data = io.BytesIO()
             image.save(data, format='JPEG')
             data = base64.b64encode(data.getbuffer()).decode('ascii')
-            result.append(
+            yield (
                 '<image'
                 ' width="100%"'
                 ' height="100%"'
@@ -954,9 +1820,9 @@ class WordCloud(object):
             y *= self.scale
 
             # Get text metrics
-            font = ImageFont.truetype(self.font_path, int(font_size * self.scale))
-            (size_x, size_y), (offset_x, offset_y) = font.font.getsize(word)
-            ascent, descent = font.getmetrics()
+            metrics = self._measurements.metrics(word, self.font_path,
+                                                 int(font_size * self.scale))
+            (size_x, size_y), (offset_x, offset_y), ascent, descent = metrics
 
             # Compute text bounding box
             min_x = -offset_x
@@ -976,7 +1842,7 @@ class WordCloud(object):
 
             # Create node
             attributes = ' '.join('{}="{}"'.format(k, v) for k, v in attributes.items())
-            result.append(
+            yield (
                 '<text'
                 ' transform="{}"'
                 ' font-size="{}"'
@@ -987,7 +1853,7 @@ class WordCloud(object):
                 .format(
                     transform,
                     font_size * self.scale,
-                    color,
+                    _svg_color(color),
                     saxutils.escape(word)
                 )
             )
@@ -995,8 +1861,378 @@ class WordCloud(object):
         # TODO draw contour
 
         # Complete SVG file
-        result.append('</svg>')
-        return '\n'.join(result)
+        yield '</svg>'
+
+    def _estimate_max_font_size(self, frequencies, random_state,
+                                deadline=None):
+        """Font size for the most frequent word if max_font_size is None.
+
+        The two most frequent words are laid out starting from the height of
+        the canvas, and the harmonic mean of their sizes is used. The
+        largest fitting sizes are found by bisection, which gives the same
+        sizes as the linear search.
+
+        Estimates are remembered for the same words, canvas and parameters.
+        If self.random_state is set, they are only reused for the same state
+        of the random number generator, which is then advanced as if the
+        words had been laid out, so layouts stay reproducible.
+
+        Returns None if the deadline passed before the words were laid out.
+        """
+        state = None
+        if self.random_state is not None:
+            state = random_state.getstate()
+        key = (tuple(frequencies[:2]), self.height, self.width,
+               self._get_mask_state().digest,
+               self.font_path, self.margin, self.prefer_horizontal,
+               self.font_step, self.min_font_size, self.relative_scaling,
+               self.repeat, self.max_words, self.collision, self.placement,
+               self.max_probes, state)
+        if key in self._max_font_sizes:
+            font_size, state = self._max_font_sizes[key]
+            if state is not None:
+                random_state.setstate(state)
+            return font_size
+        self._generate_from_frequencies(dict(frequencies[:2]),
+                                        self.height, "bisect", deadline)
+        if self.n_words_skipped_:
+            return None
+        # find font sizes
+        sizes = [x[1] for x in self.layout_]
+        try:
+            font_size = int(2 * sizes[0] * sizes[1]
+                            / (sizes[0] + sizes[1]))
+        # quick fix for if self.layout_ contains less than 2 values
+        # on very small images it can be empty
+        except IndexError:
+            try:
+                font_size = sizes[0]
+            except IndexError:
+                raise ValueError(
+                    "Couldn't find space to draw. Either the Canvas size"
+                    " is too small or too much of the image is masked "
+                    "out.")
+        if len(self._max_font_sizes) >= 16:
+            self._max_font_sizes.clear()
+        self._max_font_sizes[key] = (
+            font_size, None if state is None else random_state.getstate())
+        return font_size
+
+    def _largest_possible_size(self, word, font_size, free_square):
+        """Largest size below font_size whose box fits in a free square."""
+        def fits(size):
+            box_size = self._measurements.box(word, self.font_path, size)
+            return min(box_size) + self.margin <= free_square
+        return self._search_font_size(font_size, fits)
+
+    def _largest_fitting_size(self, occupancy, word, font_size):
+        """Largest size below font_size for which word fits on the canvas."""
+        def fits(size):
+            box_width, box_height = self._measurements.box(
+                word, self.font_path, size)
+            return occupancy.fits(box_height + self.margin,
+                                  box_width + self.margin)
+        return self._search_font_size(font_size, fits)
+
+    def _search_font_size(self, font_size, fits):
+        """Largest size on the font_step grid below font_size that fits.
+
+        Text is assumed to grow with the font size, so that all sizes below
+        a size that fits fit as well. Returns a size below min_font_size if
+        no size can fit.
+        """
+        # usually the next size fits, so gallop down before bisecting
+        # for the smallest number of steps that fits
+        n_steps = (font_size - self.min_font_size) // self.font_step
+
+        def fits_steps(k):
+            return fits(font_size - k * self.font_step)
+
+        lo, hi = 1, 1
+        while hi < n_steps and not fits_steps(hi):
+            lo, hi = hi + 1, min(2 * hi, n_steps)
+        if n_steps < 1 or (hi == n_steps and not fits_steps(hi)):
+            return self.min_font_size - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if fits_steps(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return font_size - lo * self.font_step
+
+    def _keep_placements(self, frequencies, layout):
+        """Placements of layout that can be kept for the new frequencies.
+
+        Returns a list with an entry ``[(word, freq), font_size, position,
+        orientation, color]`` for each word in frequencies. Position,
+        orientation and color are None for words that need to be placed.
+        """
+        # both layouts start from max_font_size, or from the size of the
+        # largest word if it was estimated
+        start_size = self.max_font_size
+        if start_size is None:
+            start_size = layout[0][1]
+
+        # previous placements by word and the font size the word was meant
+        # to get, before it was made smaller to fit
+        previous = {}
+        font_size = start_size
+        last_freq = 1.
+        for (word, freq), size, position, orientation, color in layout:
+            font_size = self._scale_font_size(font_size, freq / last_freq)
+            previous.setdefault((word, font_size), []).append(
+                (size, position, orientation, color))
+            font_size, last_freq = size, freq
+
+        # keep the words that are meant to get the same font size as before
+        font_size = start_size
+        last_freq = 1.
+        placements = []
+        for word, freq in frequencies:
+            if freq == 0:
+                continue
+            font_size = self._scale_font_size(font_size, freq / last_freq)
+            last_freq = freq
+            if previous.get((word, font_size)):
+                placement = previous[(word, font_size)].pop(0)
+                font_size = placement[0]
+                placements.append([(word, freq)] + list(placement))
+            else:
+                placements.append([(word, freq), font_size, None, None, None])
+
+        return placements
+
+    def _scale_font_size(self, font_size, ratio):
+        """Font size for a word ratio times as frequent as the last one."""
+        rs = self.relative_scaling
+        if rs == 0:
+            return font_size
+        return int(round((rs * float(ratio) + (1 - rs)) * font_size))
+
+    def _normalize_frequencies(self, frequencies):
+        """Most frequent words as a sorted list, the largest frequency is 1."""
+        # make sure frequencies are sorted and normalized
+        frequencies = sorted(frequencies.items(), key=itemgetter(1), reverse=True)
+        if len(frequencies) <= 0:
+            raise ValueError("We need at least 1 word to plot a word cloud, "
+                             "got %d." % len(frequencies))
+        frequencies = frequencies[:self.max_words]
+
+        # largest entry will be 1
+        max_frequency = float(frequencies[0][1])
+
+        return [(word, freq / max_frequency) for word, freq in frequencies]
+
+    def _repeat_frequencies(self, frequencies):
+        """Pad frequencies with repeated words if repeat is set."""
+        if self.repeat and len(frequencies) < self.max_words:
+            # pad frequencies with repeating words.
+            times_extend = int(np.ceil(self.max_words / len(frequencies))) - 1
+            # get smallest frequency
+            frequencies_org = list(frequencies)
+            downweight = frequencies[-1][1]
+            for i in range(times_extend):
+                frequencies.extend([(word, freq * downweight ** (i + 1))
+                                    for word, freq in frequencies_org])
+        return frequencies
+
+    def _canvas_shape(self):
+        """Height and width of the canvas of a layout."""
+        if self.mask is not None:
+            return self.mask.shape[:2]
+        return self.height, self.width
+
+    def _empty_canvas(self):
+        """Occupancy map and occupied array for a new layout."""
+        mask_state = self._get_mask_state()
+        height, width = self._canvas_shape()
+        occupancy = mask_state.empty_occupancy(
+            height, width, self.collision == "glyph").copy(
+                max_probes=self.max_probes, coarse=self.coarse_search,
+                n_threads=_get_n_threads(self.n_jobs),
+                placement=self.placement)
+
+        # occupied pixels: the mask, and the words as they are placed
+        if mask_state.occupied is not None:
+            occupied = mask_state.occupied.copy()
+        else:
+            occupied = np.zeros((height, width), dtype=np.uint8)
+        return occupancy, occupied
+
+    def _place_word(self, word, font_size, occupancy, random_state,
+                    font_size_search, deadline=None, executor=None):
+        """Find a position for word, making it smaller until it fits.
+
+        Returns the font size, orientation and position of the word. The
+        position is None if the word does not fit with min_font_size, or if
+        the deadline passed first, in which case the font size is at least
+        min_font_size. If executor is given, the canvas is scanned for
+        several candidate sizes at once on its threads.
+        """
+        if random_state.random() < self.prefer_horizontal:
+            orientation = None
+        else:
+            orientation = Image.ROTATE_90
+        tried_other_orientation = False
+        first_try = True
+        while True:
+            if font_size < self.min_font_size:
+                # font-size went too small
+                return font_size, orientation, None
+            if deadline is not None and time.perf_counter() > deadline:
+                return font_size, orientation, None
+            # try to find a position
+            if self.collision == "glyph":
+                # find places where the pixels of the word are free
+                # transpose font optionally
+                transposed_font = get_transposed_font(self.font_path,
+                                                      font_size, orientation)
+                sprite, offset = self._glyph_sprite(word, transposed_font)
+                result = occupancy.sample_sprite(sprite, random_state)
+            else:
+                # get size of resulting text
+                box_width, box_height = self._measurements.box(
+                    word, self.font_path, font_size, orientation)
+                # most words fit at the first try, so the candidates are
+                # only scanned for in advance once that failed
+                if (executor is not None and not first_try
+                        and occupancy.needs_scan(box_height + self.margin,
+                                                 box_width + self.margin)):
+                    self._count_candidates(occupancy, word, font_size,
+                                           orientation,
+                                           tried_other_orientation,
+                                           font_size_search, executor)
+                # find possible places using integral image:
+                result = occupancy.sample_position(box_height + self.margin,
+                                                   box_width + self.margin,
+                                                   random_state)
+                offset = self.margin // 2
+            if result is not None:
+                # Found a place
+                x, y = np.array(result) + offset
+                return font_size, orientation, (x, y)
+            first_try = False
+            # if we didn't find a place, make font smaller
+            # but first try to rotate!
+            if not tried_other_orientation and self.prefer_horizontal < 1:
+                orientation = (Image.ROTATE_90 if orientation is None else
+                               Image.ROTATE_90)
+                tried_other_orientation = True
+            elif (self.collision == "bbox"
+                  and font_size_search == "bisect"):
+                # jump to the largest size that fits somewhere
+                font_size = self._largest_fitting_size(occupancy, word,
+                                                       font_size)
+                orientation = None
+            elif (self.collision == "bbox"
+                  and min(box_width, box_height) + self.margin
+                  > occupancy.largest_free_square()):
+                # skip the sizes that are too large for any free square
+                font_size = self._largest_possible_size(
+                    word, font_size, occupancy.largest_free_square())
+                orientation = None
+            else:
+                font_size -= self.font_step
+                orientation = None
+
+    def _count_candidates(self, occupancy, word, font_size, orientation,
+                          tried_other_orientation, font_size_search,
+                          executor):
+        """Count the free positions for the boxes _place_word tries next.
+
+        The candidates are taken in the order _place_word tries them: the
+        current box, the other orientation, then smaller sizes, until there
+        is a box to scan for each thread.
+        """
+        def candidates():
+            yield font_size, orientation
+            if not tried_other_orientation and self.prefer_horizontal < 1:
+                yield font_size, Image.ROTATE_90
+            # smaller sizes in the order of the linear search, or of the
+            # gallop that starts the bisection
+            n_steps = 1
+            while font_size - n_steps * self.font_step >= self.min_font_size:
+                yield font_size - n_steps * self.font_step, None
+                if font_size_search == "bisect":
+                    n_steps *= 2
+                else:
+                    n_steps += 1
+
+        n_threads = _get_n_threads(self.n_jobs)
+        sizes = []
+        for size, rotation in candidates():
+            box_width, box_height = self._measurements.box(
+                word, self.font_path, size, rotation)
+            box_size = (box_height + self.margin, box_width + self.margin)
+            if occupancy.needs_scan(*box_size):
+                sizes.append(box_size)
+                if len(sizes) == n_threads:
+                    break
+        occupancy.count_sizes(sizes, executor)
+
+    def _candidate_pool(self):
+        """Thread pool to scan for candidate sizes with, or None."""
+        n_threads = _get_n_threads(self.n_jobs)
+        if (not self.speculative or self.collision != "bbox"
+                or self.placement != "random" or n_threads < 2):
+            # a single thread would only scan the same sizes with overhead
+            return None
+        return ThreadPoolExecutor(n_threads)
+
+    def _word_sprite(self, word, font_size, orientation):
+        """Grayscale image of word, with its position in the top left corner.
+
+        The sprite is kept for later calls if keep_sprites is set.
+        """
+        key = (word, self.font_path, font_size, orientation)
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            font = get_transposed_font(self.font_path, font_size, orientation)
+            sprite = Image.new("L", self._measurements.box(
+                word, self.font_path, font_size, orientation))
+            ImageDraw.Draw(sprite).text((0, 0), word, fill="white", font=font)
+            if self.keep_sprites:
+                self._sprites[key] = sprite
+        return sprite
+
+    def _prune_sprites(self):
+        """Forget the sprites of words that are not in the layout."""
+        used = set()
+        for (word, _), font_size, _, orientation, _ in self.layout_:
+            for size in (font_size, int(font_size * self.scale)):
+                used.add((word, self.font_path, size, orientation))
+        self._sprites = {key: sprite for key, sprite in self._sprites.items()
+                         if key in used}
+
+    def _draw_word(self, occupancy, occupied, word, font_size, orientation,
+                   x, y):
+        """Draw a placed word into the occupied array and occupancy map.
+
+        The word is rendered on its own, so the cost does not depend on the
+        size of the canvas, and only the box covered by it is updated.
+        """
+        sprite = self._word_sprite(word, font_size, orientation)
+        width, height = sprite.size
+        box = occupied[x:x + height, y:y + width]
+        np.maximum(box, np.asarray(sprite)[:box.shape[0], :box.shape[1]],
+                   out=box)
+        occupancy.update(occupied, x, y, height, width)
+
+    def _glyph_sprite(self, word, font):
+        """Pixels covered by word, grown by half the margin.
+
+        Returns a boolean array and the position of the text origin in it,
+        relative to a position returned by sample_sprite.
+        """
+        grow = self.margin // 2
+        left, top, right, bottom = font.getbbox(word)
+        img = Image.new("L", (right - left + 2 * grow, bottom - top + 2 * grow))
+        ImageDraw.Draw(img).text((grow - left, grow - top), word,
+                                 fill="white", font=font)
+        sprite = _dilate(np.asarray(img) > 0, grow)
+        # sampled positions are one pixel above / left of the sprite
+        return sprite, np.array([1 + grow - top, 1 + grow - left])
 
     def _get_bolean_mask(self, mask):
         """Cast to two dimensional boolean mask."""
@@ -1017,9 +2253,25 @@ class WordCloud(object):
         if self.mask is None or self.contour_width == 0:
             return img
 
-        mask = self._get_bolean_mask(self.mask) * 255
-        contour = Image.fromarray(mask.astype(np.uint8))
-        contour = contour.resize(img.size)
+        # color the contour
+        color = Image.new(img.mode, (1, 1), self.contour_color).getpixel((0, 0))
+        img.paste(color, (0, 0), self._contour_image(img.size))
+        return img
+
+    def _contour_image(self, size):
+        """Mask of the contour pixels, 255 on the contour and 0 elsewhere.
+
+        The contour is kept for the same mask, size and contour_width, so
+        drawing it again, for example after recolor, is cheap.
+        """
+        mask_state = self._get_mask_state()
+        key = (mask_state.digest, size, self.contour_width)
+        if self._contour is not None and self._contour[0] == key:
+            return self._contour[1]
+
+        mask = mask_state.boolean_mask
+        contour = Image.fromarray(mask.astype(np.uint8) * np.uint8(255))
+        contour = contour.resize(size)
         contour = contour.filter(ImageFilter.FIND_EDGES)
         contour = np.array(contour)
 
@@ -1031,13 +2283,6 @@ class WordCloud(object):
         radius = self.contour_width / 10
         contour = Image.fromarray(contour)
         contour = contour.filter(ImageFilter.GaussianBlur(radius=radius))
-        contour = np.array(contour) > 0
-        contour = np.dstack((contour, contour, contour))
-
-        # color the contour
-        ret = np.array(img) * np.invert(contour)
-        if self.contour_color != 'black':
-            color = Image.new(img.mode, img.size, self.contour_color)
-            ret += np.array(color) * contour
-
-        return Image.fromarray(ret)
+        contour = contour.point(lambda value: 255 if value > 0 else 0)
+        self._contour = key, contour
+        return contour